@@ -0,0 +1,185 @@
+from neo4j import AsyncGraphDatabase, AsyncDriver
+from dataclasses_custom import Document, Entity, LinkVector, SimilarityConfig, WriteConfig, LoadConfig
+from loader import (Neo4jExecutor, DB_NAME, FILES_QUERY, GET_DOCUMENT_BY_FILENAME_QUERY,
+                    SIMILARITY_EDGE_STRING, CONNECTION_BETWEEN_ENTS_STRING, UPLOAD_ARTICLES_QUERY, UPLOAD_ENTITIES_QUERY, UPLOAD_USED_IN_QUERY,
+                    ARTICLE_HASHES_QUERY, MARK_ARTICLES_LOADED_QUERY)
+from collapser import create_changed_similarity_links, create_changed_similarity_links_between, entity_cooccurrence
+from jobs import job_fingerprint, cross_file_stage, STAGE_DOCUMENTS, STAGE_IN_FILE_SIMILARITY, STAGE_APPEARANCE
+from scipy.sparse import csr_matrix
+from collections import Counter, defaultdict
+from itertools import chain
+from timeit import default_timer
+import numpy as np
+import asyncio
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+class StageTimer:
+
+    timings: Counter[str]
+
+    def __init__(self):
+        self.timings = Counter()
+
+    def add(self, stage: str, elapsed: float):
+        self.timings[stage] += elapsed
+
+    def report(self) -> dict[str,float]:
+        for stage, elapsed in self.timings.items():
+            logging.info(f"{stage}: {elapsed:.2f}s")
+        return dict(self.timings)
+
+class AsyncNeo4jExecutor:
+
+    loader: Neo4jExecutor
+    uri: str
+    auth: tuple[str,str]
+
+    def __init__(self, loader: Neo4jExecutor, uri: str, auth: tuple[str,str]):
+        self.loader = loader
+        self.uri = uri
+        self.auth = auth
+
+    @property
+    def write_config(self) -> WriteConfig:
+        return self.loader.writer.config
+
+    async def _write(self, driver: AsyncDriver, body: str, rows: list[dict], name: str, timer: StageTimer, context: str | None = None, **params):
+        start = default_timer()
+        async with driver.session(database=DB_NAME) as session:
+            await self.loader.writer.write_async(session, body, rows, name, context, **params)
+        timer.add(f"write {name}", default_timer() - start)
+
+    async def _get_document_vectors(self, driver: AsyncDriver, filename: str, timer: StageTimer) -> tuple[list[str],csr_matrix]:
+        start = default_timer()
+        store = self.loader.vector_store
+        if not store.has(filename):
+            logging.info(f"No local vectors for {filename}, fetching them from database")
+            result_dict = defaultdict(dict)
+            async with driver.session(database=DB_NAME) as session:
+                records, _ = await self.loader.queries.run_async(session, 'get_documents', GET_DOCUMENT_BY_FILENAME_QUERY, filename=filename)
+                for record in records:
+                    result_dict[record['url']][Entity(name=record['entity'], type_=record['type'])] = record['count']
+            await asyncio.to_thread(store.write, filename, list(result_dict.keys()), list(result_dict.values()))
+        vectors = await asyncio.to_thread(store.read, filename)
+        timer.add("fetch vectors", default_timer() - start)
+        return vectors
+
+    async def _score(self, timer: StageTimer, stage: str, function, *args) -> list[LinkVector]:
+        start = default_timer()
+        links = await asyncio.to_thread(function, *args)
+        timer.add(stage, default_timer() - start)
+        return links
+
+    async def _upload_documents(self, driver: AsyncDriver, docs: list[Document], filename: str, timer: StageTimer):
+        articles = {doc.url: doc.neo4j_article() for doc in reversed(docs)}
+        entities = sorted({ent for doc in docs for ent in doc.entities}, key=lambda ent: ent.index)
+        await asyncio.gather(
+            self._write(driver, UPLOAD_ARTICLES_QUERY, sorted(articles.values(), key=lambda row: row['url']), 'upload_articles', timer, filename, filename=filename),
+            self._write(driver, UPLOAD_ENTITIES_QUERY, [{"name": ent.name, "type": ent.type_} for ent in entities], 'upload_entities', timer, filename))
+        await self._write(driver,
+                          UPLOAD_USED_IN_QUERY,
+                          sorted(chain.from_iterable(doc.neo4j_used_in() for doc in docs), key=lambda row: (row['entity'], row['url'])),
+                          'upload_used_in',
+                          timer,
+                          filename,
+                          filename=filename)
+
+    def _prune_similarity_links(self, filename: str, similarity_config: SimilarityConfig | None):
+        with self.loader.driver.session(database=DB_NAME) as session:
+            self.loader.prune_similarity_links(session, filename, similarity_config)
+
+    def _delete_changed_article_edges(self, urls: list[str], filename: str):
+        with self.loader.driver.session(database=DB_NAME) as session:
+            self.loader.delete_changed_article_edges(session, urls, filename)
+
+    def _delete_appearance_links(self, filename: str):
+        with self.loader.driver.session(database=DB_NAME) as session:
+            self.loader.delete_appearance_links(session, filename)
+
+    async def load_data(self,
+                        docs: list[Document],
+                        filename: str,
+                        similarity_config: SimilarityConfig | None = None,
+                        load_config: LoadConfig | None = None) -> dict[str,float]:
+        load_config = load_config or LoadConfig()
+        job = self.loader.job_store.start(filename, job_fingerprint(docs, similarity_config or SimilarityConfig(), load_config))
+        timer = StageTimer()
+        start = default_timer()
+        in_flight = asyncio.Semaphore(self.write_config.max_in_flight)
+        writes: list[asyncio.Task] = []
+
+        def finished(task: asyncio.Task, job_stage: str):
+            in_flight.release()
+            if not task.cancelled() and task.exception() is None:
+                job.complete(job_stage)
+
+        async def submit(body: str, rows: list[dict], name: str, context: str, job_stage: str, **params):
+            # Producers wait here once max_in_flight writes are pending, so scored edges never pile up in memory.
+            await in_flight.acquire()
+            task = asyncio.create_task(self._write(driver, body, rows, name, timer, context, **params))
+            task.add_done_callback(lambda task: finished(task, job_stage))
+            writes.append(task)
+
+        async with AsyncGraphDatabase.driver(self.uri, auth=self.auth) as driver:
+            async with driver.session(database=DB_NAME) as session:
+                records, _ = await self.loader.queries.run_async(session, 'get_files', FILES_QUERY)
+                files = [file for file in records[0]['file'] if file != filename]
+                records, _ = await self.loader.queries.run_async(session, 'get_article_hashes', ARTICLE_HASHES_QUERY, filename=filename)
+                hashes = {record['url']: record['content_hash'] for record in records}
+            changed = self.loader.filter_changed_documents(docs, hashes)
+            if len(changed) == 0 and not job.resumed and self.loader.vector_store.has(filename):
+                logging.info(f"All articles of {filename} are already loaded, skipping")
+                self.loader.job_store.finish(job)
+                return timer.report()
+
+            urls = [doc.url for doc in docs]
+            counts = await asyncio.to_thread(self.loader.vector_store.write, filename, urls, [doc.entities for doc in docs])
+            changed_urls = {doc.url for doc in changed}
+            is_changed = np.array([url in changed_urls for url in urls], dtype=bool)
+            in_file_links = asyncio.create_task(
+                self._score(timer, "score in-file", create_changed_similarity_links, counts, urls, is_changed, similarity_config))
+            try:
+                if not job.is_done(STAGE_DOCUMENTS):
+                    await asyncio.to_thread(self._delete_changed_article_edges, [doc.url for doc in changed if doc.url in hashes], filename)
+                    await self._upload_documents(driver, changed, filename, timer)
+                    job.complete(STAGE_DOCUMENTS)
+                if not job.is_done(STAGE_APPEARANCE):
+                    if len(hashes) > 0:
+                        await asyncio.to_thread(self._delete_appearance_links, filename)
+                    await submit(CONNECTION_BETWEEN_ENTS_STRING,
+                                 self.loader._get_entity_links(entity_cooccurrence(counts, load_config.min_appearance_weight)),
+                                 'upload_appearance_edges',
+                                 filename,
+                                 STAGE_APPEARANCE,
+                                 filename=filename)
+                links = await in_file_links
+                if not job.is_done(STAGE_IN_FILE_SIMILARITY):
+                    await submit(SIMILARITY_EDGE_STRING, self.loader._prepare_similarity_links(links), 'upload_similarity_edges', filename, STAGE_IN_FILE_SIMILARITY)
+                for file in files:
+                    if job.is_done(cross_file_stage(file)):
+                        continue
+                    other_urls, other_counts = await self._get_document_vectors(driver, file, timer)
+                    links = await self._score(timer, "score between files", create_changed_similarity_links_between,
+                                              counts, urls, is_changed, other_counts, other_urls, None, similarity_config)
+                    await submit(SIMILARITY_EDGE_STRING, self.loader._prepare_similarity_links(links), 'upload_similarity_edges', file, cross_file_stage(file))
+                await asyncio.gather(*writes)
+                await asyncio.to_thread(self._prune_similarity_links, filename, similarity_config)
+                await self._write(driver,
+                                  MARK_ARTICLES_LOADED_QUERY,
+                                  sorted(({'url': doc.url, 'content_hash': doc.content_hash} for doc in changed), key=lambda row: row['url']),
+                                  'mark_articles_loaded',
+                                  timer,
+                                  filename,
+                                  filename=filename)
+                self.loader.job_store.finish(job)
+            except BaseException:
+                in_file_links.cancel()
+                for task in writes:
+                    task.cancel()
+                raise
+
+        timer.add("total", default_timer() - start)
+        logging.info(f"Pipelined upload of {len(docs)} articles finished")
+        return timer.report()
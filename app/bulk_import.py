@@ -0,0 +1,241 @@
+from dataclasses_custom import Document, Entity, SimilarityConfig, WriteConfig, NerConfig
+from loader import Neo4jExecutor, DB_NAME, INDEX_ARTICLE_URL, INDEX_ARTICLE_URL_FILENAME, INDEX_ENTITY_NAME_TYPE, INDEX_ENTITY_INDEX, INDEX_ARTICLE_FILENAME, INDEX_APPEARANCE_FILENAME
+from collapser import create_similarity_links_from_matrix, create_similarity_links_between_matrices, entity_cooccurrence
+from parser import iter_json_documents, iter_json_with_ner_documents, get_ners_batch, toml_to_config
+from vector_store import DocumentVectorStore
+from ner_cache import NerCache
+from jobs import LoadJobStore
+from neo4j import GraphDatabase, Driver
+from timeit import default_timer
+from pathlib import Path
+from os import getenv
+import argparse
+import logging
+import csv
+import os
+
+logging.basicConfig(level=logging.INFO)
+
+ARRAY_DELIMITER = '|'
+
+ARTICLES_FILE = 'articles.csv'
+ENTITIES_FILE = 'entities.csv'
+USED_IN_FILE = 'used_in.csv'
+SIMILARITY_FILE = 'similarity.csv'
+APPEARANCE_FILE = 'appearance.csv'
+
+ARTICLE_HEADER = [':ID(Article)', 'url', 'filename', 'title', 'content', 'lead_content', 'recipe_label', 'tags:string[]', 'content_hash']
+ENTITY_HEADER = ['index:ID(Entity)', 'entity', 'type']
+USED_IN_HEADER = [':START_ID(Entity)', ':END_ID(Article)', 'count:int']
+SIMILARITY_HEADER = [':START_ID(Article)', ':END_ID(Article)', 'cosinus:double', 'jaccard:double']
+APPEARANCE_HEADER = [':START_ID(Entity)', ':END_ID(Entity)', 'filename', 'count:double']
+
+# Article ids are "<filename>|<url>", the LOAD CSV queries split them back on the first delimiter.
+LOAD_ARTICLE_BY_ID = """
+WITH row, split({column}, '|')[0] AS filename
+MATCH ({node}:Article {{filename: filename, url: substring({column}, size(filename) + 1)}})"""
+
+LOAD_CSV_QUERY = """
+LOAD CSV WITH HEADERS FROM $url AS row
+CALL {{
+WITH row
+{body}
+}} IN TRANSACTIONS OF {rows_per_transaction} ROWS
+"""
+
+LOAD_ARTICLES_BODY = """
+MERGE (a:Article {url: row.url, filename: row.filename})
+SET a.title = row.title, a.content = row.content, a.lead_content = row.lead_content, a.recipe_label = row.recipe_label, a.tags = coalesce(split(row.`tags:string[]`, '|'), []), a.content_hash = row.content_hash
+"""
+
+LOAD_ENTITIES_BODY = """
+MERGE (e:Entity {entity: row.entity, type: row.type})
+ON CREATE SET e.index = row.`index:ID(Entity)`
+"""
+
+LOAD_USED_IN_BODY = LOAD_ARTICLE_BY_ID.format(column='row.`:END_ID(Article)`', node='a') + """
+MATCH (e:Entity {index: row.`:START_ID(Entity)`})
+MERGE (e)-[r:USED_IN]->(a)
+SET r.count = toInteger(row.`count:int`)
+"""
+
+LOAD_SIMILARITY_BODY = LOAD_ARTICLE_BY_ID.format(column='row.`:START_ID(Article)`', node='a') + \
+    LOAD_ARTICLE_BY_ID.format(column='row.`:END_ID(Article)`', node='b').replace('WITH row,', 'WITH row, a,') + """
+MERGE (b)-[r:SIMILARITY]-(a)
+SET r.cosinus = toFloat(row.`cosinus:double`), r.jaccard = toFloat(row.`jaccard:double`)
+"""
+
+LOAD_APPEARANCE_BODY = """
+MATCH (e:Entity {index: row.`:START_ID(Entity)`})
+MATCH (ee:Entity {index: row.`:END_ID(Entity)`})
+MERGE (e)-[a:APPEARANCE {filename: row.filename}]->(ee)
+SET a.count = toFloat(row.`count:double`)
+"""
+
+def article_id(filename: str, url: str) -> str:
+    return f"{filename}|{url}"
+
+class BulkExporter:
+
+    out_dir: Path
+    vector_store: DocumentVectorStore
+    similarity_config: SimilarityConfig | None
+    min_appearance_weight: float
+    exported_files: list[str]
+    existing_files: list[str]
+    seen_entities: set[Entity]
+
+    def __init__(self,
+                 out_dir: Path,
+                 vector_store: DocumentVectorStore,
+                 similarity_config: SimilarityConfig | None = None,
+                 min_appearance_weight: float = 0.0,
+                 existing_files: list[str] | None = None):
+        self.out_dir = out_dir
+        self.vector_store = vector_store
+        self.similarity_config = similarity_config
+        self.min_appearance_weight = min_appearance_weight
+        self.exported_files = []
+        # Files already in the database the CSVs are loaded into, their vectors have to be in the vector store.
+        self.existing_files = existing_files or []
+        self.seen_entities = set()
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        for name, header in [(ARTICLES_FILE, ARTICLE_HEADER), (ENTITIES_FILE, ENTITY_HEADER), (USED_IN_FILE, USED_IN_HEADER), (SIMILARITY_FILE, SIMILARITY_HEADER),
+                             (APPEARANCE_FILE, APPEARANCE_HEADER)]:
+            self._write_rows(name, [header], mode='w')
+
+    def _write_rows(self, name: str, rows, mode: str = 'a'):
+        with open(self.out_dir / name, mode, encoding='utf-8', newline='') as file:
+            csv.writer(file).writerows(rows)
+
+    def add_file(self, docs: list[Document], filename: str):
+        start = default_timer()
+        articles = list({doc.url: doc for doc in reversed(docs)}.values())[::-1]
+        self._write_rows(ARTICLES_FILE, ([article_id(filename, doc.url), doc.url, filename, doc.title, doc.content, doc.lead_content,
+                                          doc.recipe_label, ARRAY_DELIMITER.join(doc.tags), doc.content_hash] for doc in articles))
+        new_entities = sorted({ent for doc in docs for ent in doc.entities} - self.seen_entities, key=lambda ent: ent.index)
+        self.seen_entities.update(new_entities)
+        self._write_rows(ENTITIES_FILE, ([ent.index, ent.name, ent.type_] for ent in new_entities))
+        self._write_rows(USED_IN_FILE, ([row['entity'], article_id(filename, row['url']), row['count']]
+                                        for doc in articles for row in doc.neo4j_used_in()))
+
+        urls = [doc.url for doc in articles]
+        counts = self.vector_store.write(filename, urls, [doc.entities for doc in articles])
+        links = [(filename, filename, link) for link in create_similarity_links_from_matrix(counts, urls, self.similarity_config)]
+        for other in [file for file in self.existing_files if file != filename] + self.exported_files:
+            other_urls, other_counts = self.vector_store.read(other)
+            links += [(filename, other, link)
+                      for link in create_similarity_links_between_matrices(counts, urls, other_counts, other_urls, self.similarity_config)]
+        self._write_rows(SIMILARITY_FILE, ([article_id(file1, link.url1), article_id(file2, link.url2), link.cosinus, link.jaccard]
+                                           for file1, file2, link in links))
+
+        cooccurrence = entity_cooccurrence(counts, self.min_appearance_weight)
+        entities = list(self.vector_store.vocabulary)
+        self._write_rows(APPEARANCE_FILE, (sorted((entities[row].index, entities[col].index)) + [filename, weight]
+                                           for row, col, weight in zip(cooccurrence.rows.tolist(), cooccurrence.cols.tolist(), cooccurrence.weights.tolist())))
+        self.exported_files.append(filename)
+        logging.info(f"Exported {len(articles)} articles, {len(new_entities)} new entities and {len(links)} similarity edges of {filename} "
+                     f"in {default_timer() - start:.2f}s")
+
+    def import_command(self, database: str = DB_NAME) -> str:
+        return ' '.join(["neo4j-admin database import full",
+                         f"--nodes=Article={ARTICLES_FILE}",
+                         f"--nodes=Entity={ENTITIES_FILE}",
+                         f"--relationships=USED_IN={USED_IN_FILE}",
+                         f"--relationships=SIMILARITY={SIMILARITY_FILE}",
+                         f"--relationships=APPEARANCE={APPEARANCE_FILE}",
+                         f"--array-delimiter='{ARRAY_DELIMITER}'",
+                         "--multiline-fields=true",
+                         database])
+
+def create_indexes(driver: Driver):
+    with driver.session(database=DB_NAME) as session:
+        for index in [INDEX_ARTICLE_URL, INDEX_ARTICLE_URL_FILENAME, INDEX_ENTITY_NAME_TYPE, INDEX_ENTITY_INDEX, INDEX_ARTICLE_FILENAME, INDEX_APPEARANCE_FILENAME]:
+            session.run(index)
+    logging.info("Indexes created")
+
+def load_csv(driver: Driver, import_url: str = 'file:///', config: WriteConfig | None = None):
+    config = config or WriteConfig()
+    # MERGE looks nodes up through the indexes, so they are needed before loading rather than after.
+    create_indexes(driver)
+    stages = [(ARTICLES_FILE, LOAD_ARTICLES_BODY), (ENTITIES_FILE, LOAD_ENTITIES_BODY), (USED_IN_FILE, LOAD_USED_IN_BODY),
+              (SIMILARITY_FILE, LOAD_SIMILARITY_BODY), (APPEARANCE_FILE, LOAD_APPEARANCE_BODY)]
+    with driver.session(database=DB_NAME) as session:
+        for name, body in stages:
+            start = default_timer()
+            query = LOAD_CSV_QUERY.format(body=body, rows_per_transaction=config.rows_per_transaction)
+            counters = session.run(query, url=import_url + name).consume().counters
+            logging.info(f"Loaded {name} in {default_timer() - start:.2f}s: {counters}")
+
+def existing_files(driver: Driver, vector_store: DocumentVectorStore) -> list[str]:
+    app_dir = Path(__file__).absolute().parent
+    loader = Neo4jExecutor(driver, app_dir / 'configurations', vector_store, LoadJobStore(app_dir / 'jobs'))
+    files = loader.get_files()
+    with driver.session(database=DB_NAME) as session:
+        for file in files:
+            loader.get_document_vectors(session, file)
+    logging.info(f"Scoring against {len(files)} files already in the database")
+    return files
+
+def export_files(paths: list[Path], conf_path: Path, out_dir: Path, ner_format: bool, similarity_config: SimilarityConfig | None = None,
+                 ner_config: NerConfig | None = None, min_appearance_weight: float = 0.0, driver: Driver | None = None) -> BulkExporter:
+    app_dir = Path(__file__).absolute().parent
+    with open(conf_path, 'r', encoding='utf-8') as file:
+        matches, blacklist, dictionary = toml_to_config(file.read())
+    nlp, cache = None, None
+    vector_store = DocumentVectorStore(app_dir / 'vectors')
+    exporter = BulkExporter(out_dir, vector_store, similarity_config, min_appearance_weight,
+                            existing_files(driver, vector_store) if driver is not None else None)
+    configurations = app_dir / 'configurations'
+    if not os.path.exists(configurations):
+        os.mkdir(configurations)
+    for path in paths:
+        with open(path, 'rb') as file:
+            documents = list(iter_json_with_ner_documents(file, blacklist) if ner_format else iter_json_documents(file))
+        missing = [doc for doc in documents if len(doc.entities) == 0]
+        # NER formatted articles left without entities are extracted like the page does, so the model is loaded on first need.
+        if len(missing) > 0 and nlp is None:
+            from spacy import load
+            nlp = load('pl_core_news_lg')
+            cache = NerCache(app_dir / 'cache' / 'ner_cache.sqlite')
+        for doc, entities in zip(missing, get_ners_batch(missing, nlp, dictionary, blacklist, ner_config, cache)):
+            doc.entities = entities
+        exporter.add_file(documents, path.name)
+        with open(configurations / path.name.replace('.json','.toml'), 'w', encoding='utf-8') as file:
+            file.write(str(matches))
+    return exporter
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline bulk import of scraped json files')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='Run parsing, NER and similarity locally and write import CSVs')
+    export.add_argument('files', nargs='+', type=Path)
+    export.add_argument('--config', type=Path, required=True, help='toml configuration used for every file')
+    export.add_argument('--out', type=Path, required=True)
+    export.add_argument('--ner-format', action='store_true', help='Files already contain extracted entities')
+    export.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) - 1))
+    export.add_argument('--min-appearance-weight', type=float, default=0.0, help='Skip entity co-occurrence edges lighter than this')
+    export.add_argument('--existing-database', action='store_true',
+                        help='CSVs are meant for load-csv, score similarity against the files already in the database too')
+    load = commands.add_parser('load-csv', help='Load exported CSVs into a running database with LOAD CSV')
+    load.add_argument('--import-url', default='file:///', help='Url of the folder holding the CSVs, as seen by the database')
+    commands.add_parser('create-indexes', help='Create indexes after neo4j-admin import')
+    args = parser.parse_args()
+
+    with GraphDatabase.driver(getenv('DATABASE_URL'), auth=(getenv('DATABASE_USR'), getenv('DATABASE_PASSWORD'))) as driver:
+        if args.command == 'export':
+            exporter = export_files(args.files, args.config, args.out, args.ner_format, SimilarityConfig(workers=args.workers),
+                                    min_appearance_weight=args.min_appearance_weight, driver=driver if args.existing_database else None)
+            if args.existing_database:
+                logging.info(f"Copy {args.out} into the import directory of the database and run: python {Path(__file__).name} load-csv")
+            else:
+                logging.info(f"Run in {args.out}: {exporter.import_command()}")
+                logging.info(f"Then create indexes with: python {Path(__file__).name} create-indexes")
+        elif args.command == 'load-csv':
+            load_csv(driver, args.import_url)
+        else:
+            create_indexes(driver)
+
+if __name__ == '__main__':
+    main()
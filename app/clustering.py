@@ -1,64 +1,508 @@
 from graphdatascience import GraphDataScience, Graph
 from pandas import DataFrame
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from threading import Lock, RLock, Condition
+from hashlib import sha1
+from itertools import product
+from time import monotonic
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
 import logging
-from typing import List
+from typing import List, Iterator, Callable
 from dataclasses_custom import Mode, Distance, GraphName
 
-class GraphClusterer:
+SEED_PROPERTY = 'seed'
+
+CATALOG_PREFIX = 'clustering_'
+
+COMPARISON_COLUMNS = ['community_property', 'gamma', 'theta', 'max_levels', 'random_seed', 'modularity', 'community_count',
+                      'ran_levels', 'min_size', 'median_size', 'p90_size', 'max_size', 'seconds']
+
+@dataclass(frozen=True)
+class ProjectionKey:
+    graph_name: GraphName
+    selections: tuple[str, ...]
+    metric: Distance | None = None
+    seed_property: str | None = None
+
+    @property
+    def catalog_name(self) -> str:
+        parts = self.selections + (self.metric.name if self.metric is not None else '', self.seed_property or '')
+        digest = sha1('|'.join(parts).encode('utf-8')).hexdigest()
+        return f"{self.graph_name.name}_{digest[:12]}"
+
+    @property
+    def weight_property(self) -> str:
+        return self.metric.name if self.metric is not None else 'count'
+
+@dataclass
+class RegisteredProjection:
+    owner: str
+    key: ProjectionKey
+    last_used: float
+    stale: bool = False
+
+class ProjectionRegistry:
+    # Shared by all sessions of the process, so a projection is only dropped when no session is using it.
+
+    _entries: dict[str, RegisteredProjection]
+    _pins: Counter[str]
+
+    def __init__(self):
+        self._entries = dict()
+        self._pins = Counter()
+        self._lock = RLock()
+
+    def touch(self, name: str, owner: str, key: ProjectionKey):
+        with self._lock:
+            self._entries[name] = RegisteredProjection(owner, key, monotonic())
+
+    def pin(self, name: str):
+        with self._lock:
+            self._pins[name] += 1
+
+    def unpin(self, name: str):
+        with self._lock:
+            self._pins[name] -= 1
+            if self._pins[name] <= 0:
+                del self._pins[name]
+
+    def is_pinned(self, name: str) -> bool:
+        with self._lock:
+            return self._pins[name] > 0
+
+    def is_stale(self, name: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(name)
+            return entry is not None and entry.stale
+
+    def known(self, name: str) -> bool:
+        with self._lock:
+            return name in self._entries
+
+    def forget(self, name: str):
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def containing(self, filename: str) -> List[str]:
+        with self._lock:
+            return [name for name, entry in self._entries.items() if filename in entry.key.selections]
+
+    def expired(self, ttl: float) -> List[str]:
+        with self._lock:
+            now = monotonic()
+            return [name for name, entry in self._entries.items() if entry.stale or now - entry.last_used > ttl]
+
+    def drop_unused(self, names: List[str], drop: Callable[[str], None]) -> List[str]:
+        # Pinned projections are only marked stale, their owner projects them again on the next use.
+        dropped = []
+        with self._lock:
+            for name in names:
+                if self._pins[name] > 0:
+                    if name in self._entries:
+                        self._entries[name].stale = True
+                    continue
+                drop(name)
+                self._entries.pop(name, None)
+                dropped.append(name)
+        return dropped
+
+class ProjectionManager:
+
     gds_driver: GraphDataScience
-    def __init__(self, gds_driver: GraphDataScience):
+    registry: ProjectionRegistry
+    max_projections: int
+    ttl: float
+    _projections: OrderedDict[ProjectionKey, tuple[Graph, float]]
+    _key_locks: dict[ProjectionKey, Lock]
+
+    def __init__(self, gds_driver: GraphDataScience, registry: ProjectionRegistry, max_projections: int = 4, ttl: float = 30 * 60):
         self.gds_driver = gds_driver
+        self.registry = registry
+        self.max_projections = max_projections
+        self.ttl = ttl
+        self._projections = OrderedDict()
+        self._key_locks = dict()
+        self._lock = RLock()
+        # Catalog names carry the owner, so sessions never share a projection another one mutates.
+        self.owner = uuid4().hex[:8]
+
+    @staticmethod
+    def key(selections: List[str], graph_name: GraphName, metric: Distance | None = None, seed_property: str | None = None) -> ProjectionKey:
+        if graph_name == GraphName.DocumentWithDistance and metric is None:
+            raise AttributeError("When calculating article distance you have to supply metric!")
+        if graph_name not in (GraphName.DocumentWithDistance, GraphName.EntitiesWithCoExistance):
+            raise AttributeError("For graph name you have to choose one of: DocumentWithDistance, EntitiesWithCoExistance")
+        return ProjectionKey(graph_name, tuple(sorted(selections)), metric if graph_name == GraphName.DocumentWithDistance else None, seed_property)
+
+    def _seed_offset(self, label: str, seed_property: str) -> int:
+        # Nodes without a seed start in their own community above the seeded ones.
+        result = self.gds_driver.run_cypher(
+            f"MATCH (n:{label}) WHERE n[$seed_property] IS NOT NULL RETURN coalesce(max(n[$seed_property]), -1) + 1 AS offset",
+            params={'seed_property': seed_property},
+            database='neo4j'
+        )
+        return int(result['offset'][0])
 
-    def _create_graph_projection_articles(self, selections: List[str], metric: Distance) -> Graph:
+    @staticmethod
+    def _node_properties(seed_property: str | None) -> str:
+        if seed_property is None:
+            return ''
+        return (f"sourceNodeProperties: {{ {SEED_PROPERTY}: coalesce(source[$seed_property], $offset + id(source)) }}, "
+                f"targetNodeProperties: {{ {SEED_PROPERTY}: coalesce(target[$seed_property], $offset + id(target)) }}, ")
+
+    def _project_articles(self, name: str, selections: List[str], metric: Distance, seed_property: str | None = None) -> Graph:
         query = """
             MATCH (source: Article)-[r:SIMILARITY]-(target: Article)
-            WHERE source.filename IN $selections AND target.filename IN $selections AND source.url < target.url
-            RETURN gds.graph.project('DocumentWithDistance',source,target,{{ relationshipProperties: r {{ .{metric} }} }}, {{undirectedRelationshipTypes: ['*']}})""" 
+            WHERE source.filename IN $selections AND target.filename IN $selections AND source.url < target.url AND coalesce(r.top_{metric}, true)
+            RETURN gds.graph.project($name,source,target,{{ {node_properties}relationshipProperties: r {{ .{metric} }} }}, {{undirectedRelationshipTypes: ['*']}})"""
         graph, _ = self.gds_driver.graph.cypher.project(
-            query=query.format(metric=metric.name),
+            query=query.format(metric=metric.name, node_properties=self._node_properties(seed_property)),
             database='neo4j',
-            selections=selections
+            selections=selections,
+            name=name,
+            seed_property=seed_property,
+            offset=self._seed_offset('Article', seed_property) if seed_property is not None else 0
         )
         return graph
-    
-    def _create_graph_projection_entities(self, selections: List[str]) -> Graph:
-        keys = [key.replace('.json','') for key in selections]
-        equation = ' + '.join([f"coalesce(r.{key},0)" for key in keys])
+
+    def _project_entities(self, name: str, selections: List[str], seed_property: str | None = None) -> Graph:
         query = """
-            MATCH (source: Entity)-[r:APPEARANCE]-(target: Entity)
-            WHERE source.index < target.index
-            WITH source, target, {equation} as count
+            MATCH (source: Entity)-[r:APPEARANCE]->(target: Entity)
+            WHERE r.filename IN $selections
+            WITH source, target, sum(r.count) as count
             WHERE count > 0
-            RETURN gds.graph.project('EntitiesWithCoExistance',source,target,{{ relationshipProperties: {{ count: count }} }}, {{undirectedRelationshipTypes: ['*']}})"""
+            RETURN gds.graph.project($name,source,target,{{ {node_properties}relationshipProperties: {{ count: count }} }}, {{undirectedRelationshipTypes: ['*']}})"""
         graph, _ = self.gds_driver.graph.cypher.project(
-            query.format(equation=equation),   
+            query.format(node_properties=self._node_properties(seed_property)),
             database='neo4j',
-            selections=selections
+            selections=selections,
+            name=name,
+            seed_property=seed_property,
+            offset=self._seed_offset('Entity', seed_property) if seed_property is not None else 0
         )
         return graph
 
-    def delete_graph_projection(self, graph_name: GraphName):
-        result = self.gds_driver.graph.drop(graph=graph_name.name, dbName='neo4j')
-        logging.info(result)
+    def _catalog_name(self, key: ProjectionKey) -> str:
+        return f"{CATALOG_PREFIX}{self.owner}_{key.catalog_name}"
 
-    def _create_graph_projection_with_type(self,selections: List[str], graph_name: GraphName, metric: Distance | None = None) -> Graph:
-        if graph_name == GraphName.DocumentWithDistance and metric is not None:
-            return self._create_graph_projection_articles(selections, metric)
-        elif graph_name == GraphName.DocumentWithDistance and metric is None:
-            raise AttributeError("When calculating article distance you have to supply metric!")
-        elif graph_name == GraphName.EntitiesWithCoExistance:
-            return self._create_graph_projection_entities(selections)
-        else:
-            raise AttributeError("For graph name you have to choose one of: DocumentWithDistance, EntitiesWithCoExistance")
+    def _catalog(self) -> DataFrame:
+        graphs = self.gds_driver.graph.list()
+        if len(graphs) == 0:
+            return DataFrame(columns=['graphName', 'creationTime'])
+        return graphs[graphs['graphName'].str.startswith(CATALOG_PREFIX)]
 
-    def create_graph_projection(self, selections: List[str], graph_name: GraphName, metric: Distance | None = None) -> Graph:
+    def _drop_from_catalog(self, name: str):
+        logging.info(f"Dropping projection {name} from the catalog")
+        self.gds_driver.run_cypher("CALL gds.graph.drop($name, false) YIELD graphName RETURN graphName", params={'name': name})
+
+    def _forget(self, names: List[str]):
+        with self._lock:
+            for key in [key for key in self._projections if self._catalog_name(key) in names]:
+                del self._projections[key]
+
+    def _evict_catalog(self):
+        self._forget(self.registry.drop_unused(self.registry.expired(self.ttl), self._drop_from_catalog))
+        # Projections of earlier processes are only known by their catalog entry.
+        now = datetime.now(timezone.utc)
+        graphs = self._catalog()
+        for name, created in zip(graphs['graphName'], graphs['creationTime']):
+            created = created.to_native() if hasattr(created, 'to_native') else created
+            if not self.registry.known(name) and not self.registry.is_pinned(name) and now - created > timedelta(seconds=self.ttl):
+                self._drop_from_catalog(name)
+
+    def _project(self, key: ProjectionKey) -> Graph:
+        name = self._catalog_name(key)
+        if self.gds_driver.graph.exists(name)['exists']:
+            self._drop_from_catalog(name)
+        logging.info(f"Projecting {name} for {list(key.selections)}")
+        if key.graph_name == GraphName.DocumentWithDistance:
+            return self._project_articles(name, list(key.selections), key.metric, key.seed_property)
+        return self._project_entities(name, list(key.selections), key.seed_property)
+
+    def drop(self, key: ProjectionKey):
+        with self._lock:
+            if key not in self._projections:
+                return
+            graph, _ = self._projections.pop(key)
+            logging.info(f"Dropping projection {self._catalog_name(key)}")
+            self.gds_driver.graph.drop(graph, failIfMissing=False)
+            self.registry.forget(self._catalog_name(key))
+
+    def evict(self):
+        with self._lock:
+            now = monotonic()
+            for key in [key for key, (_, last_used) in self._projections.items() if now - last_used > self.ttl and not self.registry.is_pinned(self._catalog_name(key))]:
+                self.drop(key)
+            unpinned = [key for key in self._projections if not self.registry.is_pinned(self._catalog_name(key))]
+            for key in unpinned[:max(len(self._projections) - self.max_projections, 0)]:
+                self.drop(key)
+
+    def get(self, selections: List[str], graph_name: GraphName, metric: Distance | None = None, seed_property: str | None = None) -> tuple[ProjectionKey, Graph]:
+        key = self.key(selections, graph_name, metric, seed_property)
+        name = self._catalog_name(key)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, Lock())
+        with key_lock:
+            self.evict()
+            self._evict_catalog()
+            with self._lock:
+                cached = self._projections.get(key)
+            valid = cached is not None and not self.registry.is_stale(name) and cached[0].exists()
+            # Registered before projecting, so other sessions do not take the new graph for a leftover.
+            self.registry.touch(name, self.owner, key)
+            graph = cached[0] if valid else self._project(key)
+            with self._lock:
+                self._projections[key] = (graph, monotonic())
+                self._projections.move_to_end(key)
+            self.evict()
+        return key, graph
+
+    @contextmanager
+    def pinned(self, selections: List[str], graph_name: GraphName, metric: Distance | None = None, seed_property: str | None = None) -> Iterator[Graph]:
+        name = self._catalog_name(self.key(selections, graph_name, metric, seed_property))
+        self.registry.pin(name)
         try:
-            return self._create_graph_projection_with_type(selections, graph_name, metric)
-        except AttributeError as e:
-            raise e
-        except Exception:
-            self.delete_graph_projection(graph_name)
-            return self._create_graph_projection_with_type(selections, graph_name, metric)
-        
-    def leiden_cluster(self, graph: Graph) -> DataFrame:
-        return self.gds_driver.leiden.stream(graph)
\ No newline at end of file
+            _, graph = self.get(selections, graph_name, metric, seed_property)
+            yield graph
+        finally:
+            self.registry.unpin(name)
+
+    def cached(self, selections: List[str], graph_name: GraphName, metric: Distance | None = None, node_property: str | None = None) -> Graph | None:
+        base = self.key(selections, graph_name, metric)
+        with self._lock:
+            for key, (graph, _) in reversed(self._projections.items()):
+                name = self._catalog_name(key)
+                if replace(key, seed_property=None) != base or self.registry.is_stale(name) or not graph.exists():
+                    continue
+                if node_property is not None and node_property not in graph.node_properties().explode().values:
+                    continue
+                self.registry.touch(name, self.owner, key)
+                self._projections[key] = (graph, monotonic())
+                self._projections.move_to_end(key)
+                return graph
+            return None
+
+    def invalidate(self, filename: str):
+        # Projections of every session holding the file are dropped, the ones in use are marked stale instead.
+        self._forget(self.registry.drop_unused(self.registry.containing(filename), self._drop_from_catalog))
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._projections):
+                self.drop(key)
+
+@dataclass(frozen=True)
+class LeidenParameters:
+    gamma: float = 1.0
+    theta: float = 0.01
+    max_levels: int = 10
+    random_seed: int | None = None
+
+    def config(self) -> dict:
+        config = {'gamma': self.gamma, 'theta': self.theta, 'maxLevels': self.max_levels}
+        if self.random_seed is not None:
+            config['randomSeed'] = self.random_seed
+        return config
+
+    def suffix(self) -> str:
+        suffix = f"g{self.gamma}_t{self.theta}_l{self.max_levels}"
+        if self.random_seed is not None:
+            suffix += f"_s{self.random_seed}"
+        return suffix.replace('.', '_').replace('-', 'm')
+
+def parameter_grid(gammas: List[float], thetas: List[float], max_levels: List[int], random_seeds: List[int | None]) -> list[LeidenParameters]:
+    return [LeidenParameters(gamma, theta, levels, seed) for gamma, theta, levels, seed in product(gammas, thetas, max_levels, random_seeds)]
+
+@dataclass
+class LeidenSummary:
+    community_property: str
+    parameters: LeidenParameters
+    community_count: int
+    community_distribution: dict[str, float]
+    modularity: float
+    modularities: list[float]
+    ran_levels: int
+    node_count: int
+    pre_processing_millis: int
+    compute_millis: int
+    mutate_millis: int
+    write_millis: int
+    written: bool
+    seeded: bool = False
+
+    @property
+    def clustering_millis(self) -> int:
+        return self.pre_processing_millis + self.compute_millis + self.mutate_millis
+
+    @property
+    def total_millis(self) -> int:
+        return self.clustering_millis + self.write_millis
+
+    def comparison_row(self) -> dict:
+        return {'community_property': self.community_property,
+                'gamma': self.parameters.gamma,
+                'theta': self.parameters.theta,
+                'max_levels': self.parameters.max_levels,
+                'random_seed': self.parameters.random_seed,
+                'modularity': self.modularity,
+                'community_count': self.community_count,
+                'ran_levels': self.ran_levels,
+                'min_size': self.community_distribution.get('min'),
+                'median_size': self.community_distribution.get('p50'),
+                'p90_size': self.community_distribution.get('p90'),
+                'max_size': self.community_distribution.get('max'),
+                'seconds': self.total_millis / 1000}
+
+class GraphClusterer:
+    gds_driver: GraphDataScience
+    projections: ProjectionManager
+    summaries: dict[tuple[str,str], LeidenSummary]
+    def __init__(self, gds_driver: GraphDataScience, registry: ProjectionRegistry, max_projections: int = 4, projection_ttl: float = 30 * 60):
+        self.gds_driver = gds_driver
+        self.projections = ProjectionManager(gds_driver, registry, max_projections, projection_ttl)
+        self.summaries = dict()
+
+    def delete_graph_projection(self, selections: List[str], graph_name: GraphName, metric: Distance | None = None):
+        self.projections.drop(self.projections.key(selections, graph_name, metric))
+
+    def create_graph_projection(self, selections: List[str], graph_name: GraphName, metric: Distance | None = None) -> Graph:
+        _, graph = self.projections.get(selections, graph_name, metric)
+        return graph
+
+    def write_communities(self, graph: Graph, summary: LeidenSummary) -> LeidenSummary:
+        if not summary.written:
+            write_result = self.gds_driver.graph.nodeProperties.write(graph, [summary.community_property])
+            summary.write_millis = int(write_result['writeMillis'])
+            summary.written = True
+        return summary
+
+    def leiden_cluster(self,
+                       graph: Graph,
+                       community_property: str,
+                       parameters: LeidenParameters = LeidenParameters(),
+                       write: bool = True,
+                       seeded: bool = False) -> LeidenSummary:
+        if (graph.name(), community_property) in self.summaries and community_property in graph.node_properties().explode().values:
+            summary = self.summaries[(graph.name(), community_property)]
+            return self.write_communities(graph, summary) if write else summary
+        config = parameters.config() | ({'seedProperty': SEED_PROPERTY} if seeded else {})
+        mutate_result = self.gds_driver.leiden.mutate(graph, mutateProperty=community_property, **config)
+        summary = LeidenSummary(
+            community_property=community_property,
+            parameters=parameters,
+            community_count=int(mutate_result['communityCount']),
+            community_distribution={name: float(value) for name, value in mutate_result['communityDistribution'].items()},
+            modularity=float(mutate_result['modularity']),
+            modularities=[float(modularity) for modularity in mutate_result['modularities']],
+            ran_levels=int(mutate_result['ranLevels']),
+            node_count=int(mutate_result['nodePropertiesWritten']),
+            pre_processing_millis=int(mutate_result['preProcessingMillis']),
+            compute_millis=int(mutate_result['computeMillis']),
+            mutate_millis=int(mutate_result['mutateMillis']),
+            write_millis=0,
+            written=False,
+            seeded=seeded
+        )
+        if write:
+            self.write_communities(graph, summary)
+        logging.info(f"Leiden found {summary.community_count} communities of {summary.node_count} nodes for {community_property} in {summary.total_millis}ms")
+        self.summaries[(graph.name(), community_property)] = summary
+        return summary
+
+    def sweep(self,
+              selections: List[str],
+              graph_name: GraphName,
+              community_property: str,
+              grid: List[LeidenParameters],
+              metric: Distance | None = None,
+              max_workers: int = 3,
+              memory_budget: int | None = None) -> DataFrame:
+        tasks = [ClusteringTask(parameters.suffix(), graph_name, tuple(sorted(selections)), f"{community_property}_{parameters.suffix()}",
+                                metric, parameters, write=False) for parameters in grid]
+        rows = [summary.comparison_row() for _, summary in ClusteringScheduler(self, max_workers, memory_budget).run(tasks)]
+        return DataFrame(rows, columns=COMPARISON_COLUMNS).sort_values('modularity', ascending=False, ignore_index=True)
+
+    def adopt(self, selections: List[str], graph_name: GraphName, community_property: str, metric: Distance | None = None) -> LeidenSummary:
+        graph = self.projections.cached(selections, graph_name, metric, community_property)
+        if graph is None or (graph.name(), community_property) not in self.summaries:
+            raise AttributeError(f"No clustering {community_property} in the projection, run the sweep again")
+        return self.write_communities(graph, self.summaries[(graph.name(), community_property)])
+
+    def calculate_modularity(self, selections: List[str], graph_name: GraphName, community_property: str, metric: Distance | None = None) -> DataFrame | None:
+        graph = self.projections.cached(selections, graph_name, metric, community_property)
+        if graph is None:
+            return None
+        weight_property = self.projections.key(selections, graph_name, metric).weight_property
+        result = self.gds_driver.modularity.stream(graph, communityProperty=community_property, relationshipWeightProperty=weight_property)
+        return result.set_index('communityId', drop=True)
+
+@dataclass(frozen=True)
+class ClusteringTask:
+    suffix: str
+    graph_name: GraphName
+    selections: tuple[str, ...]
+    community_property: str
+    metric: Distance | None = None
+    parameters: LeidenParameters = LeidenParameters()
+    write: bool = True
+    seed_property: str | None = None
+
+class ClusteringScheduler:
+
+    clusterer: GraphClusterer
+    max_workers: int
+    memory_budget: int | None
+
+    def __init__(self, clusterer: GraphClusterer, max_workers: int = 3, memory_budget: int | None = None):
+        self.clusterer = clusterer
+        self.max_workers = max_workers
+        self.memory_budget = memory_budget
+        self._budget = 0
+        self._reserved = 0
+        self._memory = Condition()
+
+    def _free_heap(self) -> int:
+        result = self.clusterer.gds_driver.run_cypher("CALL gds.systemMonitor() YIELD freeHeap RETURN freeHeap")
+        return int(result['freeHeap'][0])
+
+    def _reserve(self, required: int):
+        # A run larger than the whole budget is let through once nothing else runs.
+        with self._memory:
+            while self._reserved > 0 and self._reserved + required > self._budget:
+                self._memory.wait()
+            self._reserved += required
+
+    def _release(self, required: int):
+        with self._memory:
+            self._reserved -= required
+            self._memory.notify_all()
+
+    def _run(self, task: ClusteringTask) -> LeidenSummary:
+        seeded = task.seed_property is not None
+        config = task.parameters.config() | ({'seedProperty': SEED_PROPERTY} if seeded else {})
+        with self.clusterer.projections.pinned(list(task.selections), task.graph_name, task.metric, task.seed_property) as graph:
+            estimate = self.clusterer.gds_driver.leiden.mutate.estimate(graph, mutateProperty=task.community_property, **config)
+            required = int(estimate['bytesMax'])
+            logging.info(f"Clustering {task.suffix} needs up to {required / 2**20:.1f}MiB")
+            self._reserve(required)
+            try:
+                return self.clusterer.leiden_cluster(graph, task.community_property, task.parameters, task.write, seeded)
+            finally:
+                self._release(required)
+
+    def run(self, tasks: List[ClusteringTask]) -> Iterator[tuple[ClusteringTask, LeidenSummary]]:
+        if len(tasks) == 0:
+            return
+        self._budget = self.memory_budget if self.memory_budget is not None else self._free_heap()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='clustering') as pool:
+            futures = {pool.submit(self._run, task): task for task in tasks}
+            try:
+                for future in as_completed(futures):
+                    yield futures[future], future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
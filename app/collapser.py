@@ -1,78 +1,444 @@
-from dataclasses_custom import Document, LinkVector, Entity
-from collections import Counter
-from itertools import chain, product, combinations
+from dataclasses_custom import Document, LinkVector, Entity, SimilarityConfig
+from dataclasses import dataclass
+from itertools import chain
+from scipy.sparse import csr_matrix, diags, triu
+from typing import Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
 import numpy as np
-from tqdm import tqdm
 import logging
 
-def __ner_vector(counts: Counter, map: dict[Entity,int]) -> np.ndarray:
-    shape = len(map)
-    vec = np.zeros(shape,dtype=float)
-    
-    for key, value in counts.items():
-        vec[map[key]] = value
-        
-    return vec / (np.sqrt(np.sum(vec**2)) + 1e-10) 
-
-def __calculate_cosine(count1: Counter, count2: Counter) -> float:
-    index = dict()
-    
-    for idx, key in enumerate(set(chain(count1.keys(),count2.keys()))):
-            index[key] = idx
-            
-    vec1 = __ner_vector(count1, index)
-    vec2 = __ner_vector(count2, index)
-    return vec1 @ vec2
-
-def __calculate_jaccard(count1: Counter, count2: Counter) -> float:
-    top, bottom = 0, 0
-    bottom = sum(count2.values())
-    for key in count1:
-        top += (count1[key] + count2[key]) * (key in count2)
-        bottom += count1[key]
-        
-    return top / (bottom + 1e5)
-
-
-def calculate_distances(ents1: dict[Entity,int], ents2: dict[Entity,int]) -> tuple[float,float]:
-    counter_ents1 = Counter(ents1)
-    counter_ents2 = Counter(ents2)
-            
- 
-    return __calculate_jaccard(counter_ents1, counter_ents2), \
-    __calculate_cosine(counter_ents1, counter_ents2)
-    
-def create_similarity_links(documents: list[Document]) -> list[LinkVector]:
+SIMILARITY_BLOCK_SIZE = 2048
+PAIR_BLOCK_SIZE = 200_000
+MINHASH_PRIME = (1 << 31) - 1
+
+_WORKER_STATE: dict = dict()
+
+@dataclass
+class EntityMatrix:
+    counts: csr_matrix
+    presence: csr_matrix
+    normalised: csr_matrix
+    totals: np.ndarray
+
+    @property
+    def n_docs(self) -> int:
+        return self.counts.shape[0]
+
+@dataclass
+class SimilarityBatch:
+    rows: np.ndarray
+    cols: np.ndarray
+    cosinus: np.ndarray
+    jaccard: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+@dataclass
+class CooccurrenceBatch:
+    rows: np.ndarray
+    cols: np.ndarray
+    weights: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+def build_vocabulary(*entity_maps: list[dict[Entity,int]]) -> dict[Entity,int]:
+    vocabulary: dict[Entity,int] = dict()
+    for ents in chain(*entity_maps):
+        for ent in ents:
+            vocabulary.setdefault(ent, len(vocabulary))
+    return vocabulary
+
+def build_count_matrix(entity_maps: list[dict[Entity,int]], vocabulary: dict[Entity,int]) -> csr_matrix:
+    indptr, indices, data = [0], [], []
+    for ents in entity_maps:
+        for ent, count in ents.items():
+            indices.append(vocabulary[ent])
+            data.append(count)
+        indptr.append(len(indices))
+    # Explicit zero counts are kept on purpose: they still count as shared entities in modified jaccard.
+    return csr_matrix((np.asarray(data, dtype=float), np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+                      shape=(len(entity_maps), len(vocabulary)))
+
+def with_columns(counts: csr_matrix, n_columns: int) -> csr_matrix:
+    return csr_matrix((counts.data, counts.indices, counts.indptr), shape=(counts.shape[0], n_columns))
+
+def entity_matrix_from_counts(counts: csr_matrix) -> EntityMatrix:
+    presence = counts.copy()
+    presence.data = np.ones_like(presence.data)
+    norms = np.sqrt(np.bincount(np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr)),
+                                weights=counts.data ** 2,
+                                minlength=counts.shape[0])) + 1e-10
+    normalised = counts.copy()
+    normalised.data = normalised.data / np.repeat(norms, np.diff(counts.indptr))
+    totals = np.asarray(counts.sum(axis=1)).ravel()
+    return EntityMatrix(counts=counts, presence=presence, normalised=normalised, totals=totals)
+
+def build_inverted_index(matrix: EntityMatrix, max_entity_frequency: int | None = None) -> csr_matrix:
+    # Rows are entities and the column indices of each row are its posting list of documents.
+    index = matrix.presence.T.tocsr()
+    if max_entity_frequency is not None:
+        frequencies = np.diff(index.indptr)
+        stop_entities = frequencies > max_entity_frequency
+        logging.info(f"Skipping {stop_entities.sum()} stop entities in candidate generation")
+        index = (diags((~stop_entities).astype(float)) @ index).tocsr()
+        index.eliminate_zeros()
+    return index
+
+@dataclass
+class RowBlockScorer:
+    # Transposes of the right documents are built once, every row block is then scored by two sparse products.
+    counts_t: csr_matrix
+    presence_t: csr_matrix
+    normalised_t: csr_matrix
+    totals: np.ndarray
+    n_right: int
+    candidate_docs: csr_matrix | None = None
+    candidate_index: csr_matrix | None = None
+
+def row_block_scorer(left: EntityMatrix, right: EntityMatrix, max_entity_frequency: int | None = None) -> RowBlockScorer:
+    scorer = RowBlockScorer(counts_t=right.counts.T.tocsr(),
+                            presence_t=right.presence.T.tocsr(),
+                            normalised_t=right.normalised.T.tocsr(),
+                            totals=right.totals,
+                            n_right=right.n_docs)
+    if max_entity_frequency is not None:
+        # Pairs have to share an entity below the cap, their scores still count every entity.
+        left_index = build_inverted_index(left, max_entity_frequency)
+        scorer.candidate_index = left_index if left is right else build_inverted_index(right, max_entity_frequency)
+        scorer.candidate_docs = left_index.T.tocsr()
+    return scorer
+
+def _sorted_entries(product: csr_matrix, block_start: int, n_right: int) -> tuple[np.ndarray,np.ndarray]:
+    product = product.tocsr()
+    product.sum_duplicates()
+    coo = product.tocoo()
+    return (coo.row.astype(np.int64) + block_start) * n_right + coo.col.astype(np.int64), coo.data
+
+def _lookup(keys: np.ndarray, other_keys: np.ndarray, other_values: np.ndarray) -> tuple[np.ndarray,np.ndarray]:
+    # Both key arrays are sorted, entries of the other product missing for a key are read as zero.
+    if len(other_keys) == 0:
+        return np.zeros(len(keys), dtype=bool), np.zeros(len(keys))
+    positions = np.minimum(np.searchsorted(other_keys, keys), len(other_keys) - 1)
+    found = other_keys[positions] == keys
+    return found, np.where(found, other_values[positions], 0.0)
+
+def score_row_block(left: EntityMatrix, scorer: RowBlockScorer, start: int, stop: int, upper_only: bool = False) -> SimilarityBatch:
+    overlap = left.counts[start:stop] @ scorer.presence_t + left.presence[start:stop] @ scorer.counts_t
+    keys, overlaps = _sorted_entries(overlap, start, scorer.n_right)
+    cosinus_keys, cosinus = _sorted_entries(left.normalised[start:stop] @ scorer.normalised_t, start, scorer.n_right)
+    _, cosinus = _lookup(keys, cosinus_keys, cosinus)
+    rows, cols = keys // scorer.n_right, keys % scorer.n_right
+    keep = cols > rows if upper_only else np.ones(len(keys), dtype=bool)
+    if scorer.candidate_docs is not None:
+        candidate_keys, _ = _sorted_entries(scorer.candidate_docs[start:stop] @ scorer.candidate_index, start, scorer.n_right)
+        found, _ = _lookup(keys, candidate_keys, np.zeros(len(candidate_keys)))
+        keep &= found
+    jaccard = overlaps / (left.totals[rows] + scorer.totals[cols] + 1e5)
+    keep &= jaccard * cosinus > 0
+    return SimilarityBatch(rows=rows[keep], cols=cols[keep], cosinus=cosinus[keep], jaccard=jaccard[keep])
+
+def score_pairs(left: EntityMatrix, right: EntityMatrix, rows: np.ndarray, cols: np.ndarray) -> SimilarityBatch:
+    batches = []
+    for start in range(0, len(rows), PAIR_BLOCK_SIZE):
+        block_rows, block_cols = rows[start:start + PAIR_BLOCK_SIZE], cols[start:start + PAIR_BLOCK_SIZE]
+        cosinus = np.asarray(left.normalised[block_rows].multiply(right.normalised[block_cols]).sum(axis=1)).ravel()
+        overlap = np.asarray(
+            left.counts[block_rows].multiply(right.presence[block_cols]).sum(axis=1) +
+            left.presence[block_rows].multiply(right.counts[block_cols]).sum(axis=1)
+        ).ravel()
+        jaccard = overlap / (left.totals[block_rows] + right.totals[block_cols] + 1e5)
+        keep = jaccard * cosinus > 0
+        batches.append(SimilarityBatch(rows=block_rows[keep], cols=block_cols[keep], cosinus=cosinus[keep], jaccard=jaccard[keep]))
+    return concatenate_batches(batches)
+
+def score_row_blocks(left: EntityMatrix,
+                     scorer: RowBlockScorer,
+                     upper_only: bool = False,
+                     start: int = 0,
+                     stop: int | None = None) -> SimilarityBatch:
+    stop = left.n_docs if stop is None else stop
+    return concatenate_batches([score_row_block(left, scorer, block_start, min(block_start + SIMILARITY_BLOCK_SIZE, stop), upper_only)
+                                for block_start in range(start, stop, SIMILARITY_BLOCK_SIZE)])
+
+def score_candidates(left: EntityMatrix,
+                     right: EntityMatrix,
+                     upper_only: bool = False,
+                     max_entity_frequency: int | None = None) -> SimilarityBatch:
+    batch = score_row_blocks(left, row_block_scorer(left, right, max_entity_frequency), upper_only)
+    logging.info(f"Scored {len(batch)} document pairs sharing an entity")
+    return batch
+
+def minhash_signatures(matrix: EntityMatrix, n_hashes: int, seed: int) -> np.ndarray:
+    generator = np.random.default_rng(seed)
+    a = generator.integers(1, MINHASH_PRIME, size=n_hashes, dtype=np.int64)
+    b = generator.integers(0, MINHASH_PRIME, size=n_hashes, dtype=np.int64)
+    indptr, indices = matrix.presence.indptr, matrix.presence.indices.astype(np.int64)
+    non_empty = np.diff(indptr) > 0
+    signatures = np.full((matrix.n_docs, n_hashes), MINHASH_PRIME, dtype=np.int64)
+    if indices.size == 0:
+        return signatures
+    for k in range(n_hashes):
+        hashed = (a[k] * indices + b[k]) % MINHASH_PRIME
+        signatures[non_empty, k] = np.minimum.reduceat(hashed, indptr[:-1][non_empty])
+    return signatures
+
+def lsh_candidate_pairs(left_signatures: np.ndarray,
+                        right_signatures: np.ndarray | None,
+                        bands: int,
+                        rows_per_band: int) -> tuple[np.ndarray,np.ndarray]:
+    # With right_signatures None the pairs are searched within the left documents only (upper triangle).
+    n_left = left_signatures.shape[0]
+    signatures = left_signatures if right_signatures is None else np.vstack([left_signatures, right_signatures])
+    n_right = n_left if right_signatures is None else right_signatures.shape[0]
+    non_empty = np.flatnonzero(signatures[:, 0] < MINHASH_PRIME)
+    keys = []
+    for band in range(bands):
+        band_slice = np.ascontiguousarray(signatures[non_empty, band * rows_per_band:(band + 1) * rows_per_band])
+        _, buckets = np.unique(band_slice.view(np.dtype((np.void, band_slice.dtype.itemsize * rows_per_band))).ravel(),
+                               return_inverse=True)
+        order = np.argsort(buckets, kind='stable')
+        boundaries = np.flatnonzero(np.diff(buckets[order])) + 1
+        for members in np.split(non_empty[order], boundaries):
+            if len(members) < 2:
+                continue
+            if right_signatures is None:
+                first, second = np.triu_indices(len(members), 1)
+                rows, cols = members[first], members[second]
+            else:
+                left_members, right_members = members[members < n_left], members[members >= n_left] - n_left
+                rows, cols = np.repeat(left_members, len(right_members)), np.tile(right_members, len(left_members))
+            keys.append(rows * n_right + cols)
+    if len(keys) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    unique_keys = np.unique(np.concatenate(keys))
+    return unique_keys // n_right, unique_keys % n_right
+
+def estimate_lsh_recall(left: EntityMatrix,
+                        right: EntityMatrix,
+                        rows: np.ndarray,
+                        cols: np.ndarray,
+                        upper_only: bool,
+                        sample_size: int,
+                        seed: int) -> float:
+    generator = np.random.default_rng(seed)
+    sample = np.sort(generator.choice(left.n_docs, size=min(sample_size, left.n_docs), replace=False))
+    shared = (left.presence[sample] @ right.presence.T).tocoo()
+    exact_rows, exact_cols = sample[shared.row].astype(np.int64), shared.col.astype(np.int64)
+    if upper_only:
+        keep = exact_cols > exact_rows
+        exact_rows, exact_cols = exact_rows[keep], exact_cols[keep]
+    exact = score_pairs(left, right, exact_rows, exact_cols)
+    if len(exact) == 0:
+        return 1.0
+    found = np.isin(exact.rows * right.n_docs + exact.cols, rows * right.n_docs + cols)
+    return float(found.mean())
+
+def lsh_candidates(left: EntityMatrix,
+                   right: EntityMatrix,
+                   config: SimilarityConfig,
+                   upper_only: bool = False) -> tuple[np.ndarray,np.ndarray]:
+    n_hashes = config.lsh_bands * config.lsh_rows
+    left_signatures = minhash_signatures(left, n_hashes, config.lsh_seed)
+    right_signatures = None if upper_only else minhash_signatures(right, n_hashes, config.lsh_seed)
+    rows, cols = lsh_candidate_pairs(left_signatures, right_signatures, config.lsh_bands, config.lsh_rows)
+    logging.info(f"LSH ({config.lsh_bands} bands x {config.lsh_rows} rows) proposed {len(rows)} candidate pairs")
+    if config.recall_sample_size > 0 and left.n_docs > 0:
+        recall = estimate_lsh_recall(left, right, rows, cols, upper_only, config.recall_sample_size, config.lsh_seed)
+        logging.info(f"Estimated LSH recall against exact mode on {min(config.recall_sample_size, left.n_docs)} documents: {recall:.3f}")
+    return rows, cols
+
+def _matrix_arrays(matrix: EntityMatrix) -> tuple[np.ndarray,np.ndarray,np.ndarray,tuple[int,int]]:
+    return matrix.counts.data, matrix.counts.indices, matrix.counts.indptr, matrix.counts.shape
+
+def _init_similarity_worker(left_arrays: tuple, right_arrays: tuple | None, upper_only: bool, max_entity_frequency: int | None):
+    data, indices, indptr, shape = left_arrays
+    left = entity_matrix_from_counts(csr_matrix((data, indices, indptr), shape=shape))
+    if right_arrays is None:
+        right = left
+    else:
+        data, indices, indptr, shape = right_arrays
+        right = entity_matrix_from_counts(csr_matrix((data, indices, indptr), shape=shape))
+    _WORKER_STATE.clear()
+    _WORKER_STATE.update(left=left, right=right, upper_only=upper_only, max_entity_frequency=max_entity_frequency)
+
+def _score_row_range(start: int, stop: int) -> SimilarityBatch:
+    left, right = _WORKER_STATE['left'], _WORKER_STATE['right']
+    if 'scorer' not in _WORKER_STATE:
+        _WORKER_STATE['scorer'] = row_block_scorer(left, right, _WORKER_STATE['max_entity_frequency'])
+    return score_row_blocks(left, _WORKER_STATE['scorer'], _WORKER_STATE['upper_only'], start, stop)
+
+def _score_pair_slice(rows: np.ndarray, cols: np.ndarray) -> SimilarityBatch:
+    return score_pairs(_WORKER_STATE['left'], _WORKER_STATE['right'], rows, cols)
+
+def score_documents_parallel(left: EntityMatrix,
+                             right: EntityMatrix,
+                             config: SimilarityConfig,
+                             upper_only: bool = False) -> SimilarityBatch:
+    # Workers receive the compact CSR arrays once at start-up, tasks only carry row ranges or candidate id arrays.
+    initargs = (_matrix_arrays(left), None if left is right else _matrix_arrays(right), upper_only, config.max_entity_frequency)
+    # Forking the threaded streamlit process could copy held locks into the workers, so they start from a fork server.
+    with ProcessPoolExecutor(max_workers=config.workers, mp_context=multiprocessing.get_context('forkserver'),
+                             initializer=_init_similarity_worker, initargs=initargs) as pool:
+        if config.approximate:
+            rows, cols = lsh_candidates(left, right, config, upper_only)
+            pair_chunk = max(config.chunk_size, -(-len(rows) // (config.workers * 4)))
+            futures = [pool.submit(_score_pair_slice, rows[start:start + pair_chunk], cols[start:start + pair_chunk])
+                       for start in range(0, len(rows), pair_chunk)]
+        else:
+            futures = [pool.submit(_score_row_range, start, min(start + config.chunk_size, left.n_docs))
+                       for start in range(0, left.n_docs, config.chunk_size)]
+        batches = [future.result() for future in as_completed(futures)]
+    logging.info(f"Scored {len(futures)} work units on {config.workers} workers")
+    return concatenate_batches(batches)
+
+def score_documents(left: EntityMatrix,
+                    right: EntityMatrix,
+                    config: SimilarityConfig,
+                    upper_only: bool = False) -> SimilarityBatch:
+    if config.workers > 1 and left.n_docs > config.chunk_size:
+        return score_documents_parallel(left, right, config, upper_only)
+    if config.approximate:
+        rows, cols = lsh_candidates(left, right, config, upper_only)
+        return score_pairs(left, right, rows, cols)
+    return score_candidates(left, right, upper_only, config.max_entity_frequency)
+
+def _top_k_mask(endpoints: np.ndarray, edge_ids: np.ndarray, scores: np.ndarray, k: int, n_edges: int) -> np.ndarray:
+    order = np.lexsort((-scores, endpoints))
+    sorted_endpoints = endpoints[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_endpoints[1:] != sorted_endpoints[:-1]])
+    ranks = np.arange(len(order)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(order)]))
+    mask = np.zeros(n_edges, dtype=bool)
+    mask[edge_ids[order][ranks < k]] = True
+    return mask
+
+def sparsify_batch(batch: SimilarityBatch, config: SimilarityConfig, same_documents: bool) -> SimilarityBatch:
+    # Every threshold that is set has to hold. Top k within a batch is only a pre-filter, the loader settles it over all batches.
+    thresholds = [minimum > 0 for minimum in (config.min_cosinus, config.min_jaccard)]
+    if config.top_k is None and not any(thresholds):
+        return batch
+    batch = sort_batch(batch)
+    keep = np.ones(len(batch), dtype=bool)
+    for scores, minimum, is_set in ((batch.cosinus, config.min_cosinus, thresholds[0]), (batch.jaccard, config.min_jaccard, thresholds[1])):
+        if is_set:
+            keep &= scores >= minimum
+    if config.top_k is not None:
+        candidates = np.flatnonzero(keep)
+        offset = 0 if same_documents else (batch.rows.max(initial=-1) + 1)
+        endpoints = np.concatenate([batch.rows[candidates], batch.cols[candidates] + offset])
+        edge_ids = np.tile(candidates, 2)
+        top = np.zeros(len(batch), dtype=bool)
+        for scores in (batch.cosinus, batch.jaccard):
+            top |= _top_k_mask(endpoints, edge_ids, np.tile(scores[candidates], 2), config.top_k, len(batch))
+        keep &= top
+    logging.info(f"Sparsification kept {keep.sum()} of {len(batch)} similarity edges")
+    return SimilarityBatch(rows=batch.rows[keep], cols=batch.cols[keep], cosinus=batch.cosinus[keep], jaccard=batch.jaccard[keep])
+
+def concatenate_batches(batches: list[SimilarityBatch]) -> SimilarityBatch:
+    if len(batches) == 0:
+        return SimilarityBatch(rows=np.empty(0, dtype=np.int64), cols=np.empty(0, dtype=np.int64),
+                               cosinus=np.empty(0), jaccard=np.empty(0))
+    return SimilarityBatch(
+        rows=np.concatenate([batch.rows for batch in batches]),
+        cols=np.concatenate([batch.cols for batch in batches]),
+        cosinus=np.concatenate([batch.cosinus for batch in batches]),
+        jaccard=np.concatenate([batch.jaccard for batch in batches])
+    )
+
+def sort_batch(batch: SimilarityBatch) -> SimilarityBatch:
+    order = np.lexsort((batch.cols, batch.rows))
+    return SimilarityBatch(rows=batch.rows[order], cols=batch.cols[order], cosinus=batch.cosinus[order], jaccard=batch.jaccard[order])
+
+def batch_to_link_vectors(batch: SimilarityBatch, urls1: list[str], urls2: list[str]) -> list[LinkVector]:
+    batch = sort_batch(batch)
+    return [
+        LinkVector(
+            url1=urls1[row],
+            url2=urls2[col],
+            cosinus=float(cos),
+            jaccard=float(jacc)
+        )
+        for row, col, cos, jacc in zip(batch.rows.tolist(), batch.cols.tolist(), batch.cosinus, batch.jaccard)
+    ]
+
+def entity_cooccurrence(counts: csr_matrix, min_weight: float = 0.0) -> CooccurrenceBatch:
+    # Summed over documents, (c_i + c_j) / 2 for every pair of entities present together is (C^T B + B^T C) / 2.
+    matrix = entity_matrix_from_counts(counts)
+    product = (matrix.counts.T @ matrix.presence).tocsr()
+    weights = triu((product + product.T) / 2, k=1).tocoo()
+    keep = (weights.data > 0) & (weights.data >= min_weight)
+    rows, cols, values = weights.row[keep].astype(np.int64), weights.col[keep].astype(np.int64), weights.data[keep]
+    order = np.lexsort((cols, rows))
+    logging.info(f"Computed {len(order)} entity co-occurrence edges ({(~keep).sum()} dropped below weight {min_weight})")
+    return CooccurrenceBatch(rows=rows[order], cols=cols[order], weights=values[order])
+
+def create_similarity_links(documents: list[Document], config: SimilarityConfig | None = None) -> list[LinkVector]:
+    entity_maps = [doc.entities for doc in documents]
+    return create_similarity_links_from_matrix(build_count_matrix(entity_maps, build_vocabulary(entity_maps)),
+                                               [doc.url for doc in documents],
+                                               config)
+
+def create_similarity_links_from_matrix(counts: csr_matrix, urls: list[str], config: SimilarityConfig | None = None) -> list[LinkVector]:
     logging.info("Calculating Distances")
-    vectors = []
-    for doc1, doc2 in tqdm(combinations(documents,2)):
-        jacc, cos = calculate_distances(doc1.entities,doc2.entities)
-        if jacc * cos > 0:
-            vectors.append(
-                LinkVector(
-                    url1=doc1.url,
-                    url2=doc2.url,
-                    cosinus=cos,
-                    jaccard=jacc
-                )
-            )
-    return vectors
-
-def create_similarity_links_between_files(documents: list[Document], other_docs: dict[str,dict[Entity,int]]) -> list[LinkVector]:
-    vectors = []
-    for doc, url in product(documents, other_docs.keys()):
-        jacc, cos = calculate_distances(doc.entities, other_docs[url])
-        if jacc * cos > 0:
-            vectors.append(
-                LinkVector(
-                    url1=doc.url,
-                    url2=url,
-                    cosinus=cos,
-                    jaccard=jacc
-                )
-            )
-    return vectors
-            
-    
-
-    
\ No newline at end of file
+    config = config or SimilarityConfig()
+    matrix = entity_matrix_from_counts(counts)
+    batch = sparsify_batch(score_documents(matrix, matrix, config, upper_only=True), config, same_documents=True)
+    return batch_to_link_vectors(batch, urls, urls)
+
+def create_similarity_links_between_files(documents: list[Document],
+                                          other_docs: dict[str,dict[Entity,int]],
+                                          config: SimilarityConfig | None = None) -> list[LinkVector]:
+    entity_maps = [doc.entities for doc in documents]
+    other_maps = list(other_docs.values())
+    vocabulary = build_vocabulary(entity_maps, other_maps)
+    return create_similarity_links_between_matrices(build_count_matrix(entity_maps, vocabulary),
+                                                    [doc.url for doc in documents],
+                                                    build_count_matrix(other_maps, vocabulary),
+                                                    list(other_docs.keys()),
+                                                    config)
+
+def create_similarity_links_between_matrices(counts: csr_matrix,
+                                             urls: list[str],
+                                             other_counts: csr_matrix,
+                                             other_urls: list[str],
+                                             config: SimilarityConfig | None = None) -> list[LinkVector]:
+    config = config or SimilarityConfig()
+    n_columns = max(counts.shape[1], other_counts.shape[1])
+    batch = score_documents(entity_matrix_from_counts(with_columns(counts, n_columns)),
+                            entity_matrix_from_counts(with_columns(other_counts, n_columns)),
+                            config)
+    batch = sparsify_batch(batch, config, same_documents=False)
+    return batch_to_link_vectors(batch, urls, other_urls)
+
+# Pairs of two unchanged articles keep their stored edges, only pairs with a changed article are scored again.
+def create_changed_similarity_links(counts: csr_matrix, urls: list[str], changed: np.ndarray, config: SimilarityConfig | None = None) -> list[LinkVector]:
+    changed_rows, unchanged_rows = np.flatnonzero(changed), np.flatnonzero(~changed)
+    if len(changed_rows) == 0:
+        return []
+    changed_urls = [urls[row] for row in changed_rows]
+    links = create_similarity_links_from_matrix(counts[changed_rows], changed_urls, config)
+    if len(unchanged_rows) > 0:
+        links += create_similarity_links_between_matrices(counts[changed_rows], changed_urls, counts[unchanged_rows], [urls[row] for row in unchanged_rows], config)
+    return links
+
+def create_changed_similarity_links_between(counts: csr_matrix,
+                                            urls: list[str],
+                                            changed: np.ndarray,
+                                            other_counts: csr_matrix,
+                                            other_urls: list[str],
+                                            other_changed: np.ndarray | None = None,
+                                            config: SimilarityConfig | None = None) -> list[LinkVector]:
+    changed_rows, unchanged_rows = np.flatnonzero(changed), np.flatnonzero(~changed)
+    other_changed_rows = np.array([], dtype=np.int64) if other_changed is None else np.flatnonzero(other_changed)
+    links = []
+    if len(changed_rows) > 0 and len(other_urls) > 0:
+        links += create_similarity_links_between_matrices(counts[changed_rows], [urls[row] for row in changed_rows], other_counts, other_urls, config)
+    if len(unchanged_rows) > 0 and len(other_changed_rows) > 0:
+        links += create_similarity_links_between_matrices(counts[unchanged_rows],
+                                                          [urls[row] for row in unchanged_rows],
+                                                          other_counts[other_changed_rows],
+                                                          [other_urls[row] for row in other_changed_rows],
+                                                          config)
+    return links
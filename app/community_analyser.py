@@ -6,6 +6,7 @@ from pandas import DataFrame, Series
 import logging
 from numpy import select
 from pathlib import Path
+from instrumentation import QueryRecorder
 import tomllib
 
 logging.basicConfig(level=logging.INFO)
@@ -47,7 +48,7 @@ RETURN tag, count(tag) as tagCount
 
 GRAPH_PROJECTION_FOR_MODULARITY_QUERY = '''
 MATCH (source: Article)-[r:SIMILARITY]-(target: Article)
-WHERE source.url < target.url AND source.{communityId} IS NOT NULL AND target.{communityId} IS NOT NULL
+WHERE source.url < target.url AND source.{communityId} IS NOT NULL AND target.{communityId} IS NOT NULL AND coalesce(r.top_{metric}, true)
 RETURN gds.graph.project('Modularity_Articles',
 source,
 target,
@@ -58,9 +59,9 @@ target,
 }}, {{undirectedRelationshipTypes: ['*']}})'''
 
 GRAPH_PROJECTION_FOR_MODULARITY_QUERY_ENTS = '''
-MATCH (source:Entity)-[r:APPEARANCE]-(target:Entity)
-WHERE source.index < target.index AND source.{communityId} IS NOT NULL AND target.{communityId} IS NOT NULL
-WITH source, target, {equation} as count
+MATCH (source:Entity)-[r:APPEARANCE]->(target:Entity)
+WHERE r.filename IN $selections AND source.{communityId} IS NOT NULL AND target.{communityId} IS NOT NULL
+WITH source, target, sum(r.count) as count
 WHERE count > 0
 RETURN gds.graph.project('Modularity_Entities',
 source,
@@ -124,9 +125,9 @@ RETURN ee.entity as name, ee.type as type, sum(CASE WHEN a.{key} = aa.{key} then
 """
 
 ENTITY_CONNECTION_ENTITY = """
-MATCH (e:Entity)-[r:APPEARANCE]-(ee:Entity)
-WHERE e.index = '{entity_index}'
-RETURN ee.entity as name, ee.type as type, sum(CASE WHEN e.{key} = ee.{key} THEN {equation} ELSE 0 END) as sameCluster, sum(CASE WHEN e.{key} <> ee.{key} THEN {equation} ELSE 0 END) as differentCluster
+MATCH (e:Entity {{index: $entity_index}})-[r:APPEARANCE]-(ee:Entity)
+WHERE r.filename IN $selections
+RETURN ee.entity as name, ee.type as type, sum(CASE WHEN e.{key} = ee.{key} THEN r.count ELSE 0 END) as sameCluster, sum(CASE WHEN e.{key} <> ee.{key} THEN r.count ELSE 0 END) as differentCluster
 """
 
 ENTITY_LIST_ENTITY = """
@@ -147,10 +148,12 @@ RETURN e.entity as name, e.type as type
 class Analyzer:
     neo4j_driver: Driver
     gds_driver: GraphDataScience
+    queries: QueryRecorder
 
-    def __init__(self, neo4j_driver: Driver, gds_driver: GraphDataScience):
+    def __init__(self, neo4j_driver: Driver, gds_driver: GraphDataScience, queries: QueryRecorder | None = None):
         self.neo4j_driver = neo4j_driver
         self.gds_driver = gds_driver
+        self.queries = queries or QueryRecorder()
 
         try:
             self.neo4j_driver.verify_connectivity()
@@ -158,7 +161,9 @@ class Analyzer:
             logging.error("connection error")
 
     def get_ents_from_community(self, communityId: int, key: str, mode: Mode) -> DataFrame:    
-        records, _, _ = self.neo4j_driver.execute_query(
+        records, _, _ = self.queries.execute_query(
+            self.neo4j_driver,
+            'get_ents_from_community',
             ENTITY_GROUP_QUERY if mode == Mode.articles else ENTITY_GROUP_QUERY_BY_ENTITY,
             communityId=communityId,
             database_='neo4j',
@@ -169,7 +174,9 @@ class Analyzer:
         return DataFrame(all_records).groupby(['entity','type'],as_index=False).sum()
     
     def get_article_tags_from_community(self, communityId: int, key: str, mode: Mode) -> DataFrame:
-        records, _, _  = self.neo4j_driver.execute_query(
+        records, _, _  = self.queries.execute_query(
+            self.neo4j_driver,
+            'get_article_tags_from_community',
             TAG_COUNTER_FOR_ARTICLE_COMMUNITY if mode == Mode.articles else TAG_COUNTER_FOR_ENTITY_COMMUNITY,
             communityId=communityId,
             database_='neo4j',
@@ -187,9 +194,7 @@ class Analyzer:
                 raise AttributeError('With articles mode distance is mandatory')
             query = GRAPH_PROJECTION_FOR_MODULARITY_QUERY.format(communityId=key, metric=distance.name) 
         else:
-            keys = [k.replace('.json','') for k in selections]
-            equation = ' + '.join([f"coalesce(r.{key},0)" for key in keys])
-            query = GRAPH_PROJECTION_FOR_MODULARITY_QUERY_ENTS.format(communityId=key,equation=equation) 
+            query = GRAPH_PROJECTION_FOR_MODULARITY_QUERY_ENTS.format(communityId=key) 
         logging.info(f"{mode.name}: {query}")
         graph_name = 'Modularity_Articles' if mode == Mode.articles else 'Modularity_Entities'
         try:
@@ -223,7 +228,9 @@ class Analyzer:
     
 
     def get_article_tags_class(self, selections: list[str], key: str, mode: Mode) -> DataFrame:
-        records, _, _ = self.neo4j_driver.execute_query(
+        records, _, _ = self.queries.execute_query(
+            self.neo4j_driver,
+            'get_article_tags_class',
             ARTICLE_TAGS_COMMUNITY_MINING_QUERY if mode == Mode.articles else ARTICLE_TAGS_COMMUNITY_MINING_QUERY_ENTITY,
             selections=selections,
             key=key,
@@ -260,7 +267,9 @@ class Analyzer:
         query_match = MATCHING_ENTS_QUERY_ARTICLE if mode == Mode.articles else MATCHING_ENTS_QUERY_ENTITY
         query_non_match = NON_MATCHING_ENTS_QUERY_ARTICLE if mode == Mode.articles else NON_MATCHING_ENTS_QUERY_ENTITY
         for key, matches_ in matches.items():
-            records, _, _ = self.neo4j_driver.execute_query(
+            records, _, _ = self.queries.execute_query(
+            self.neo4j_driver,
+            'matching_ents',
             query_match,
             selection=key,
             communityId=communityId,
@@ -269,7 +278,9 @@ class Analyzer:
             key=cluster_key
             )
             matching_scores.append(records[0].data()['counts'])
-            records, _, _ = self.neo4j_driver.execute_query(
+            records, _, _ = self.queries.execute_query(
+            self.neo4j_driver,
+            'non_matching_ents',
             query_non_match,
             selection=key,
             communityId=communityId,
@@ -285,7 +296,9 @@ class Analyzer:
     
     def is_clustering_needed(self, key: str, mode: Mode) -> bool:
         node_type = 'Article' if mode == Mode.articles else 'Entity'
-        records, _, _ = self.neo4j_driver.execute_query(
+        records, _, _ = self.queries.execute_query(
+            self.neo4j_driver,
+            'is_clustering_needed',
             f"""
             MATCH (e:{node_type})
             WHERE e.{key} IS NOT NULL
@@ -298,7 +311,9 @@ class Analyzer:
     
     def get_community_nodes(self, key: str, mode: Mode) -> DataFrame:
         if mode == Mode.entities:
-            records, _, _ = self.neo4j_driver.execute_query(
+            records, _, _ = self.queries.execute_query(
+                self.neo4j_driver,
+                'get_entity_community_nodes',
                 """
                 MATCH (e:Entity)
                 WHERE e[$key] IS NOT NULL
@@ -309,7 +324,9 @@ class Analyzer:
             )
 
         else:
-            records, _, _ = self.neo4j_driver.execute_query(
+            records, _, _ = self.queries.execute_query(
+                self.neo4j_driver,
+                'get_article_community_nodes',
                 """
                 MATCH (a:Article)
                 WHERE a[$key] IS NOT NULL
@@ -322,7 +339,9 @@ class Analyzer:
     # df.drop(columns=['n_appearances','n_communities'])
     def analyse_cluster_sizes_distribution(self, key: str, mode: Mode) -> DataFrame:
         node_type = 'Article' if mode == Mode.articles else 'Entity'
-        records, _, _ = self.neo4j_driver.execute_query(
+        records, _, _ = self.queries.execute_query(
+            self.neo4j_driver,
+            'analyse_cluster_sizes_distribution',
             CLUSTER_DISTRIBUTION_QUERY.format(
                 node_type=node_type,
                 key=key
@@ -333,18 +352,22 @@ class Analyzer:
     
     def analyse_entity_connection_articles(self, key: str, entity_index: str, selections: list[str]) -> DataFrame:
         query = ENTITY_CONNECTION_ARTICLE.format(key=key, entity_index=entity_index, selections=selections)
-        records, _, _ = self.neo4j_driver.execute_query(
+        records, _, _ = self.queries.execute_query(
+            self.neo4j_driver,
+            'analyse_entity_connection_articles',
             query,
             database_= 'neo4j'
         )
         return DataFrame([record.data() for record in records])
     
     def analyse_entity_connection_entities(self, key: str, entity_index: str, selections: list[str]) -> DataFrame:
-        keys = [k.replace('.json','') for k in selections]
-        equation = ' + '.join([f"coalesce(r.{k},0)" for k in keys])
-        query = ENTITY_CONNECTION_ENTITY.format(key=key,entity_index=entity_index, equation=equation)
-        records, _, _ = self.neo4j_driver.execute_query(
+        query = ENTITY_CONNECTION_ENTITY.format(key=key)
+        records, _, _ = self.queries.execute_query(
+            self.neo4j_driver,
+            'analyse_entity_connection_entities',
             query,
+            entity_index=entity_index,
+            selections=selections,
             database_= 'neo4j'
         )
         return DataFrame([record.data() for record in records])
@@ -352,7 +375,9 @@ class Analyzer:
     def get_ents_with_key(self, key: str, mode: Mode) -> Series:
         query = ENTITY_LIST_ARTICLE if mode == Mode.articles else ENTITY_LIST_ENTITY
         query = query.format(key=key)
-        records, _, _ = self.neo4j_driver.execute_query(
+        records, _, _ = self.queries.execute_query(
+            self.neo4j_driver,
+            'get_ents_with_key',
             query,
             database_= 'neo4j'
         )
@@ -1,8 +1,8 @@
 from dataclasses import dataclass, field
-from collections import Counter
-from itertools import combinations
+from hashlib import sha256
 from pathlib import Path
 from enum import Flag, auto
+import json
 
 CONFIGURATION_FOLDER = Path(__file__).absolute().parent / 'configurations' 
 
@@ -46,6 +46,10 @@ class Entity:
     name: str
     type_ : str
 
+    @property
+    def index(self) -> str:
+        return self.name + "_" + self.type_
+
 @dataclass
 class Document():
     url: str
@@ -56,28 +60,64 @@ class Document():
     tags: list[str]
     entities: dict[Entity,int] = field(default_factory=dict)
 
-    def neo4j_json_list(self) -> list[dict[str,str|int]]:
-        return [self._format_json(ent,count) for ent, count in self.entities.items()]
-        
-    def _format_json(self, ent: Entity, count: int) -> dict[str,str]:
+    @property
+    def content_hash(self) -> str:
+        # Entities are hashed too, so an article re-extracted with another configuration is uploaded again.
+        payload = json.dumps([self.url, self.title, self.content, self.lead_content, self.recipe_label, self.tags,
+                              sorted([ent.name, ent.type_, count] for ent, count in self.entities.items())], ensure_ascii=False)
+        return sha256(payload.encode('utf-8')).hexdigest()
+
+    def neo4j_article(self) -> dict[str,str|list[str]]:
         return {
             "url": self.url,
             "title": self.title,
             "content": self.content,
             "lead_content": self.lead_content,
             "recipe_label": self.recipe_label,
-            "tags": self.tags,
-            "ent_name": ent.name,
-            "ent_type": ent.type_,
-            "count": count
+            "tags": self.tags
         }
-    
-    def return_tuple_connections(self) -> Counter[tuple[Entity,Entity]]:
-        return Counter({tuple(sorted((tup1,tup2),key=lambda x: x.name)):(self.entities[tup1]+self.entities[tup2])/2 for tup1, tup2 in combinations(self.entities.keys(),2)})
+
+    def neo4j_used_in(self) -> list[dict[str,str|int]]:
+        return [{"url": self.url, "entity": ent.index, "count": count} for ent, count in self.entities.items()]
     
 @dataclass()
 class LinkVector:
     url1: str
     url2: str
     cosinus: float
-    jaccard: float
\ No newline at end of file
+    jaccard: float
+
+@dataclass
+class SimilarityConfig:
+    max_entity_frequency: int | None = None
+    approximate: bool = False
+    lsh_bands: int = 32
+    lsh_rows: int = 4
+    lsh_seed: int = 42
+    recall_sample_size: int = 200
+    top_k: int | None = None
+    min_cosinus: float = 0.0
+    min_jaccard: float = 0.0
+    workers: int = 1
+    chunk_size: int = 2048
+
+@dataclass
+class NerConfig:
+    batch_size: int = 64
+    n_process: int = 1
+
+@dataclass
+class LoadConfig:
+    chunked: bool = False
+    chunk_size: int = 1000
+    queue_size: int = 2
+    min_appearance_weight: float = 0.0
+    incremental: bool = False
+
+@dataclass
+class WriteConfig:
+    batch_size: int = 20_000
+    rows_per_transaction: int = 1000
+    concurrency: int = 4
+    max_retries: int = 3
+    max_in_flight: int = 2
@@ -0,0 +1,131 @@
+from neo4j import Driver, Session, ManagedTransaction, AsyncSession, AsyncManagedTransaction, Record, EagerResult, ResultSummary
+from dataclasses import dataclass, field, asdict
+from collections import Counter
+from threading import Lock
+from timeit import default_timer
+from time import time
+import logging
+import json
+
+logging.basicConfig(level=logging.INFO)
+
+def _label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+COUNTER_NAMES = ['nodes_created', 'nodes_deleted', 'relationships_created', 'relationships_deleted', 'properties_set',
+                 'labels_added', 'labels_removed', 'indexes_added', 'indexes_removed']
+
+@dataclass
+class QueryStats:
+    name: str
+    calls: int = 0
+    rows: int = 0
+    wall_time: float = 0.0
+    max_wall_time: float = 0.0
+    available_after: float = 0.0
+    consumed_after: float = 0.0
+    counters: Counter[str] = field(default_factory=Counter)
+
+    @property
+    def mean_wall_time(self) -> float:
+        return self.wall_time / max(self.calls, 1)
+
+    def add(self, wall_time: float, summary: ResultSummary, rows: int):
+        self.calls += 1
+        self.rows += rows
+        self.wall_time += wall_time
+        self.max_wall_time = max(self.max_wall_time, wall_time)
+        # The server reports both in milliseconds, they are kept in seconds like the wall time.
+        self.available_after += (summary.result_available_after or 0) / 1000
+        self.consumed_after += (summary.result_consumed_after or 0) / 1000
+        self.counters.update({name: getattr(summary.counters, name) for name in COUNTER_NAMES})
+
+    def to_dict(self) -> dict:
+        stats = asdict(self)
+        stats['counters'] = dict(+self.counters)
+        stats['mean_wall_time'] = self.mean_wall_time
+        return stats
+
+class QueryRecorder:
+
+    current: dict[str,QueryStats]
+    previous: dict[str,QueryStats]
+    totals: dict[str,QueryStats]
+    profile_names: set[str]
+    plans: dict[str,dict]
+
+    def __init__(self):
+        self.current, self.previous, self.totals = dict(), dict(), dict()
+        self.profile_names = set()
+        self.plans = dict()
+        self.page_load_started = time()
+        self._lock = Lock()
+
+    def start_page_load(self):
+        with self._lock:
+            if len(self.current) > 0:
+                self.previous = self.current
+            self.current = dict()
+            self.page_load_started = time()
+
+    def _query(self, name: str, query: str) -> str:
+        return "PROFILE " + query.lstrip() if name in self.profile_names else query
+
+    def _record(self, name: str, wall_time: float, summary: ResultSummary, rows: int):
+        with self._lock:
+            for stats in (self.current, self.totals):
+                stats.setdefault(name, QueryStats(name)).add(wall_time, summary, rows)
+            if summary.profile is not None:
+                self.plans[name] = summary.profile
+        logging.debug(f"{name}: {rows} rows in {wall_time:.3f}s")
+
+    def run(self, runner: Session | ManagedTransaction, name: str, query: str, **params) -> tuple[list[Record],ResultSummary]:
+        start = default_timer()
+        result = runner.run(self._query(name, query), **params)
+        records = list(result)
+        summary = result.consume()
+        self._record(name, default_timer() - start, summary, len(records))
+        return records, summary
+
+    async def run_async(self, runner: AsyncSession | AsyncManagedTransaction, name: str, query: str, **params) -> tuple[list[Record],ResultSummary]:
+        start = default_timer()
+        result = await runner.run(self._query(name, query), **params)
+        records = [record async for record in result]
+        summary = await result.consume()
+        self._record(name, default_timer() - start, summary, len(records))
+        return records, summary
+
+    def execute_query(self, driver: Driver, name: str, query: str, **kwargs) -> EagerResult:
+        start = default_timer()
+        result = driver.execute_query(self._query(name, query), **kwargs)
+        self._record(name, default_timer() - start, result.summary, len(result.records))
+        return result
+
+    def slowest(self, stats: dict[str,QueryStats] | None = None, n: int = 20) -> list[dict]:
+        stats = self.totals if stats is None else stats
+        return [query.to_dict() for query in sorted(stats.values(), key=lambda query: query.wall_time, reverse=True)[:n]]
+
+    def export_json(self) -> str:
+        return json.dumps({'page_load_started': self.page_load_started,
+                           'current': [stats.to_dict() for stats in self.current.values()],
+                           'previous': [stats.to_dict() for stats in self.previous.values()],
+                           'totals': [stats.to_dict() for stats in self.totals.values()]}, indent=2)
+
+    def export_prometheus(self) -> str:
+        lines = []
+        metrics = [('neo4j_query_calls_total', 'counter', 'calls'),
+                   ('neo4j_query_rows_total', 'counter', 'rows'),
+                   ('neo4j_query_wall_seconds_total', 'counter', 'wall_time'),
+                   ('neo4j_query_available_after_seconds_total', 'counter', 'available_after'),
+                   ('neo4j_query_consumed_after_seconds_total', 'counter', 'consumed_after'),
+                   ('neo4j_query_max_wall_seconds', 'gauge', 'max_wall_time')]
+        for metric, kind, attribute in metrics:
+            lines.append(f"# TYPE {metric} {kind}")
+            for stats in self.totals.values():
+                lines.append(f'{metric}{{query="{_label_value(stats.name)}"}} {getattr(stats, attribute)}')
+        lines.append("# TYPE neo4j_query_updates_total counter")
+        for stats in self.totals.values():
+            for counter, value in stats.counters.items():
+                if value > 0:
+                    lines.append(f'neo4j_query_updates_total{{query="{_label_value(stats.name)}",counter="{counter}"}} {value}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,103 @@
+from dataclasses_custom import Document
+from dataclasses import asdict, is_dataclass
+from hashlib import sha256
+from pathlib import Path
+from typing import BinaryIO
+import logging
+import json
+import os
+
+STAGE_DOCUMENTS = 'documents'
+STAGE_IN_FILE_SIMILARITY = 'in_file_similarity'
+STAGE_APPEARANCE = 'appearance'
+
+def cross_file_stage(other_file: str) -> str:
+    return f'similarity:{other_file}'
+
+def chunk_stage(n_chunk: int) -> str:
+    return f'chunk:{n_chunk}'
+
+def _update_with_configs(digest, configs):
+    for config in configs:
+        digest.update(json.dumps(asdict(config) if is_dataclass(config) else config, sort_keys=True).encode('utf-8'))
+
+def job_fingerprint(docs: list[Document], *configs) -> str:
+    digest = sha256()
+    for doc in docs:
+        digest.update(doc.content_hash.encode('utf-8'))
+    _update_with_configs(digest, configs)
+    return digest.hexdigest()
+
+# Chunked loads stream their documents, so the raw file stands in for the content hashes of its articles.
+def stream_fingerprint(content: BinaryIO, *configs) -> str:
+    digest = sha256()
+    while block := content.read(1 << 20):
+        digest.update(block)
+    content.seek(0)
+    _update_with_configs(digest, configs)
+    return digest.hexdigest()
+
+class LoadJob:
+
+    path: Path
+    filename: str
+    fingerprint: str
+    completed: list[str]
+    resumed: bool
+
+    def __init__(self, path: Path, filename: str, fingerprint: str, completed: list[str], resumed: bool):
+        self.path = path
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.completed = completed
+        self.resumed = resumed
+
+    def is_done(self, stage: str) -> bool:
+        return stage in self.completed
+
+    def complete(self, stage: str):
+        self.completed.append(stage)
+        self._save()
+        logging.info(f"Load job of {self.filename}: {stage} done")
+
+    def _save(self):
+        with open(self.path.with_suffix('.tmp'), 'w', encoding='utf-8') as file:
+            json.dump({'filename': self.filename, 'fingerprint': self.fingerprint, 'completed': self.completed}, file, ensure_ascii=False)
+        os.replace(self.path.with_suffix('.tmp'), self.path)
+
+class LoadJobStore:
+
+    root: Path
+
+    def __init__(self, root: Path):
+        self.root = root
+        if not os.path.exists(self.root):
+            os.mkdir(self.root)
+
+    def _job_path(self, filename: str) -> Path:
+        return self.root / (filename.replace('.json','') + '.job.json')
+
+    def start(self, filename: str, fingerprint: str) -> LoadJob:
+        path = self._job_path(filename)
+        if path.exists():
+            with open(path, 'r', encoding='utf-8') as file:
+                state = json.load(file)
+            if state['fingerprint'] == fingerprint:
+                logging.info(f"Resuming load job of {filename} after stages {state['completed']}")
+                return LoadJob(path, filename, fingerprint, state['completed'], resumed=True)
+            logging.info(f"Input of {filename} changed since the interrupted load, starting over")
+        job = LoadJob(path, filename, fingerprint, [], resumed=False)
+        job._save()
+        return job
+
+    def finish(self, job: LoadJob):
+        if job.path.exists():
+            os.remove(job.path)
+
+    def discard(self, filename: str):
+        path = self._job_path(filename)
+        if path.exists():
+            os.remove(path)
+
+    def pending(self) -> list[str]:
+        return sorted(path.name.removesuffix('.job.json') + '.json' for path in self.root.glob('*.job.json'))
@@ -1,14 +1,23 @@
-from neo4j import Result, Driver, Session
+from neo4j import Record, Driver, Session, AsyncSession
+from neo4j.exceptions import Neo4jError, TransientError
 import logging
-from dataclasses_custom import Document, LinkVector, Matches, Entity, Mode
+from dataclasses_custom import Document, LinkVector, Matches, Entity, SimilarityConfig, WriteConfig, LoadConfig
 from pandas import DataFrame
 from itertools import chain
 from collections import Counter
 from pathlib import Path
 import os
 from timeit import default_timer
-from collapser import create_similarity_links, create_similarity_links_between_files
+from time import sleep
+import asyncio
+from collapser import create_changed_similarity_links, create_changed_similarity_links_between, entity_cooccurrence, CooccurrenceBatch
+from vector_store import DocumentVectorStore
+from instrumentation import QueryRecorder
+from jobs import LoadJobStore, job_fingerprint, cross_file_stage, STAGE_DOCUMENTS, STAGE_IN_FILE_SIMILARITY, STAGE_APPEARANCE
+from scipy.sparse import csr_matrix
 from collections import defaultdict
+import numpy as np
+from typing import Callable
 
 logging.basicConfig(level=logging.INFO)
 
@@ -16,29 +25,80 @@ DB_NAME = 'neo4j'
 
 FILES_QUERY = 'MATCH (a:Article) RETURN COLLECT(DISTINCT a.filename) AS file'
 
-SIMILARITY_EDGE_STRING = """CALL {
-UNWIND $edges as edge
-MATCH (a:Article {url: edge.url1})
-MATCH (b:Article {url: edge.url2})
-MERGE (b)-[r:SIMILARITY {cosinus: edge.cosinus, jaccard: edge.jaccard}]-(a)
-} IN CONCURRENT TRANSACTIONS
+SIMILARITY_EDGE_STRING = """
+MATCH (a:Article {url: row.url1})
+MATCH (b:Article {url: row.url2})
+MERGE (b)-[r:SIMILARITY]-(a)
+SET r.cosinus = row.cosinus, r.jaccard = row.jaccard
 """
 
 CONNECTION_BETWEEN_ENTS_STRING = """
+MATCH (e:Entity {entity: row.name1, type: row.type1})
+MATCH (ee:Entity {entity: row.name2, type: row.type2})
+MERGE (e)-[a:APPEARANCE {filename: $filename}]->(ee)
+SET a.count = row.count
+"""
+
+UPLOAD_ARTICLES_QUERY = """
+MERGE (a:Article {url: row.url, filename: $filename})
+SET a.title = row.title, a.content = row.content, a.lead_content = row.lead_content, a.recipe_label = row.recipe_label, a.tags = row.tags
+"""
+
+# The hash is set only once every edge of the article is written, so an interrupted load still sees the article as changed.
+MARK_ARTICLES_LOADED_QUERY = """
+MATCH (a:Article {url: row.url, filename: $filename})
+SET a.content_hash = row.content_hash
+"""
+
+ARTICLE_HASHES_QUERY = """
+MATCH (a:Article {filename: $filename})
+RETURN a.url AS url, a.content_hash AS content_hash
+"""
+
+UPLOAD_ENTITIES_QUERY = """
+MERGE (e:Entity {entity: row.name, type: row.type})
+ON CREATE SET e.index = row.name + "_" + row.type
+"""
+
+UPLOAD_USED_IN_QUERY = """
+MATCH (a:Article {url: row.url, filename: $filename})
+MATCH (e:Entity {index: row.entity})
+MERGE (e)-[r:USED_IN]->(a)
+SET r.count = row.count
+"""
+
+BATCHED_WRITE_QUERY = """
+UNWIND $rows AS row
 CALL {{
-UNWIND $edges as edge
-MATCH (e:Entity {{entity: edge.name1, type: edge.type1}})
-MATCH (ee:Entity {{entity: edge.name2, type: edge.type2}})
-MERGE (e)-[a:APPEARANCE {{{key}: edge.count}}]-(ee)
-}} IN CONCURRENT TRANSACTIONS
+WITH row
+{body}
+}} IN {concurrency} CONCURRENT TRANSACTIONS OF {rows_per_transaction} ROWS
 """
 
+SUMMARY_COUNTERS = ['nodes_created', 'relationships_created', 'properties_set', 'nodes_deleted', 'relationships_deleted']
+
+RETRY_BACKOFF = 0.5
+
 GET_DOCUMENT_BY_FILENAME_QUERY = '''
 MATCH (a: Article)-[r:USED_IN]-(e: Entity)
 WHERE a.filename = $filename
 RETURN a.url as url, r.count as count, e.entity as entity, e.type as type
 '''
 
+GET_DOCUMENT_BY_URLS_QUERY = '''
+UNWIND $urls AS url
+MATCH (a:Article {url: url, filename: $filename})<-[r:USED_IN]-(e:Entity)
+RETURN a.url as url, r.count as count, e.entity as entity, e.type as type
+'''
+
+# Entities are looked up through the (entity, type) index, so only posting lists of the new file's entities are expanded.
+CANDIDATE_ARTICLES_QUERY = '''
+UNWIND $entities AS ent
+MATCH (e:Entity {entity: ent.name, type: ent.type})-[:USED_IN]->(a:Article)
+WHERE a.filename <> $filename
+RETURN a.filename AS filename, a.url AS url, count(e) AS overlap
+'''
+
 INDEX_ARTICLE_URL = """
 CREATE INDEX article_index_url IF NOT EXISTS FOR (a:Article) on (a.url)"""
 
@@ -51,14 +111,174 @@ CREATE INDEX article_index_url_filename IF NOT EXISTS FOR (a:Article) on (a.url,
 INDEX_ENTITY_INDEX = '''
 CREATE INDEX entity_index_index IF NOT EXISTS FOR (e:Entity) on (e.index)'''
 
+INDEX_ARTICLE_FILENAME = '''
+CREATE INDEX article_index_filename IF NOT EXISTS FOR (a:Article) on (a.filename)'''
+
+INDEX_APPEARANCE_FILENAME = '''
+CREATE INDEX appearance_index_filename IF NOT EXISTS FOR ()-[r:APPEARANCE]-() on (r.filename)'''
+
+# Top k over all batches: edges around the file are marked per metric by whether they are among the k best of either endpoint, edges top k under neither are removed.
+PRUNE_SIMILARITY_QUERY = '''
+MATCH (a:Article {{filename: $filename}})
+OPTIONAL MATCH (a)-[:SIMILARITY]-(b:Article)
+WITH collect(DISTINCT a) + collect(DISTINCT b) AS touched
+UNWIND touched AS n
+MATCH (n)-[r:SIMILARITY]-()
+WITH DISTINCT r
+WITH r, startNode(r) AS s, endNode(r) AS t
+CALL {{
+WITH r, s, t
+WITH r,
+     COUNT {{ (s)-[x:SIMILARITY]-() WHERE x.cosinus > r.cosinus }} < $k OR COUNT {{ (t)-[x:SIMILARITY]-() WHERE x.cosinus > r.cosinus }} < $k AS top_cosinus,
+     COUNT {{ (s)-[x:SIMILARITY]-() WHERE x.jaccard > r.jaccard }} < $k OR COUNT {{ (t)-[x:SIMILARITY]-() WHERE x.jaccard > r.jaccard }} < $k AS top_jaccard
+FOREACH (_ IN CASE WHEN top_cosinus OR top_jaccard THEN [1] ELSE [] END | SET r.top_cosinus = top_cosinus, r.top_jaccard = top_jaccard)
+FOREACH (_ IN CASE WHEN top_cosinus OR top_jaccard THEN [] ELSE [1] END | DELETE r)
+}} IN TRANSACTIONS OF {rows_per_transaction} ROWS'''
+
+DELETE_TOUCHED_ENTITIES_QUERY = '''
+MATCH (a:Article {filename: $filename})<-[:USED_IN]-(e:Entity)
+RETURN collect(DISTINCT e.index) AS entities'''
+
+DELETE_APPEARANCE_QUERY = '''
+MATCH ()-[r:APPEARANCE]->()
+WHERE r.filename = $filename
+CALL {{
+WITH r
+DELETE r
+}} IN TRANSACTIONS OF {rows_per_transaction} ROWS'''
+
+DELETE_ARTICLE_EDGES_QUERY = '''
+MATCH (a:Article {{filename: $filename}})-[r:SIMILARITY|USED_IN]-()
+CALL {{
+WITH r
+DELETE r
+}} IN TRANSACTIONS OF {rows_per_transaction} ROWS'''
+
+DELETE_CHANGED_ARTICLE_EDGES_QUERY = '''
+UNWIND $urls AS url
+MATCH (a:Article {{url: url, filename: $filename}})-[r:SIMILARITY|USED_IN]-()
+WITH DISTINCT r
+CALL {{
+WITH r
+DELETE r
+}} IN TRANSACTIONS OF {rows_per_transaction} ROWS'''
+
+DELETE_ARTICLES_QUERY = '''
+MATCH (a:Article {{filename: $filename}})
+CALL {{
+WITH a
+DETACH DELETE a
+}} IN TRANSACTIONS OF {rows_per_transaction} ROWS'''
+
+DELETE_ORPHAN_ENTITIES_QUERY = '''
+UNWIND $entities AS index
+MATCH (e:Entity {{index: index}})
+WHERE NOT (e)-[:USED_IN]->()
+CALL {{
+WITH e
+DETACH DELETE e
+}} IN TRANSACTIONS OF {rows_per_transaction} ROWS'''
+
+APPEARANCE_MIGRATION_DONE_QUERY = '''
+MATCH (m:Migration {name: 'appearance_per_file'}) RETURN count(m) > 0 AS done'''
+
+# Older files stored co-appearance as one property per file on a shared edge, every property becomes its own edge.
+APPEARANCE_MIGRATION_QUERY = '''
+MATCH (e:Entity)-[old:APPEARANCE]->(ee:Entity)
+WHERE old.filename IS NULL
+CALL {
+WITH e, old, ee
+WITH old, CASE WHEN e.index < ee.index THEN e ELSE ee END AS source, CASE WHEN e.index < ee.index THEN ee ELSE e END AS target
+UNWIND keys(old) AS key
+MERGE (source)-[r:APPEARANCE {filename: coalesce($filenames[key], key + '.json')}]->(target)
+SET r.count = coalesce(r.count, 0) + old[key]
+WITH DISTINCT old
+DELETE old
+} IN TRANSACTIONS OF 1000 ROWS'''
+
+APPEARANCE_MIGRATION_MARK_QUERY = '''
+MERGE (m:Migration {name: 'appearance_per_file'}) SET m.migrated_at = datetime()'''
+
+class BatchWriter:
+
+    config: WriteConfig
+    queries: QueryRecorder
+
+    def __init__(self, config: WriteConfig, queries: QueryRecorder):
+        self.config = config
+        self.queries = queries
+
+    # The sync and the async loader share batching, retries and reporting, only awaiting the batches differs.
+    def _batches(self, body: str, rows: list[dict]) -> tuple[str, list[list[dict]]]:
+        query = BATCHED_WRITE_QUERY.format(body=body,
+                                           concurrency=self.config.concurrency,
+                                           rows_per_transaction=self.config.rows_per_transaction)
+        return query, [rows[batch_start:batch_start + self.config.batch_size] for batch_start in range(0, len(rows), self.config.batch_size)]
+
+    def _retry_delay(self, name: str, error: Neo4jError, attempt: int) -> float:
+        if not (isinstance(error, TransientError) or 'DeadlockDetected' in (error.code or '')) or attempt == self.config.max_retries:
+            raise error
+        logging.warning(f"{name}: batch failed with {error.code}, retrying ({attempt + 1}/{self.config.max_retries})")
+        return RETRY_BACKOFF * 2 ** attempt
+
+    def _report(self, name: str, context: str | None, n_rows: int, n_batches: int, start: float, totals: Counter[str]) -> Counter[str]:
+        elapsed = default_timer() - start
+        # Query names stay the same for every file, the file only goes to the log.
+        stage = name if context is None else f"{name} ({context})"
+        logging.info(f"{stage}: wrote {n_rows} rows in {n_batches} batches in {elapsed:.2f}s "
+                     f"({n_rows / max(elapsed, 1e-9):.0f} rows/s), summary: {dict(+totals)}")
+        return totals
+
+    def write(self, session: Session, body: str, rows: list[dict], name: str, context: str | None = None, **params) -> Counter[str]:
+        start = default_timer()
+        query, batches = self._batches(body, rows)
+        totals: Counter[str] = Counter()
+        for batch in batches:
+            counters = self._run_with_retry(session, query, batch, name, params)
+            totals.update({counter: getattr(counters, counter) for counter in SUMMARY_COUNTERS})
+        return self._report(name, context, len(rows), len(batches), start, totals)
+
+    def _run_with_retry(self, session: Session, query: str, batch: list[dict], name: str, params: dict):
+        for attempt in range(self.config.max_retries + 1):
+            try:
+                _, summary = self.queries.run(session, name, query, rows=batch, **params)
+                return summary.counters
+            except Neo4jError as e:
+                sleep(self._retry_delay(name, e, attempt))
+
+    async def write_async(self, session: AsyncSession, body: str, rows: list[dict], name: str, context: str | None = None, **params) -> Counter[str]:
+        start = default_timer()
+        query, batches = self._batches(body, rows)
+        totals: Counter[str] = Counter()
+        for batch in batches:
+            counters = await self._run_with_retry_async(session, query, batch, name, params)
+            totals.update({counter: getattr(counters, counter) for counter in SUMMARY_COUNTERS})
+        return self._report(name, context, len(rows), len(batches), start, totals)
+
+    async def _run_with_retry_async(self, session: AsyncSession, query: str, batch: list[dict], name: str, params: dict):
+        for attempt in range(self.config.max_retries + 1):
+            try:
+                _, summary = await self.queries.run_async(session, name, query, rows=batch, **params)
+                return summary.counters
+            except Neo4jError as e:
+                await asyncio.sleep(self._retry_delay(name, e, attempt))
+
 class Neo4jExecutor:
     
     driver: Driver
     conf_path: Path
+    vector_store: DocumentVectorStore
+    job_store: LoadJobStore
+    queries: QueryRecorder
+    writer: BatchWriter
     
-    def __init__(self, driver: Driver, conf_path: Path):
+    def __init__(self, driver: Driver, conf_path: Path, vector_store: DocumentVectorStore, job_store: LoadJobStore, queries: QueryRecorder | None = None):
         self.driver = driver 
         self.conf_path = conf_path
+        self.vector_store = vector_store
+        self.job_store = job_store
+        self.queries = queries or QueryRecorder()
+        self.writer = BatchWriter(WriteConfig(), self.queries)
         try:
             self.driver.verify_connectivity()
         except Exception:
@@ -66,27 +286,46 @@ class Neo4jExecutor:
         
         try:
             with self.driver.session(database=DB_NAME) as session:
-                session.run(INDEX_ARTICLE_URL)
-                session.run(INDEX_ARTICLE_URL_FILENAME)
-                session.run(INDEX_ENTITY_NAME_TYPE)
-                session.run(INDEX_ENTITY_INDEX)
+                self.queries.run(session, 'create_indexes', INDEX_ARTICLE_URL)
+                self.queries.run(session, 'create_indexes', INDEX_ARTICLE_URL_FILENAME)
+                self.queries.run(session, 'create_indexes', INDEX_ENTITY_NAME_TYPE)
+                self.queries.run(session, 'create_indexes', INDEX_ENTITY_INDEX)
+                self.queries.run(session, 'create_indexes', INDEX_ARTICLE_FILENAME)
+                self.queries.run(session, 'create_indexes', INDEX_APPEARANCE_FILENAME)
         except Exception:
             logging.error(f"Indexes creation failure")
+
+        try:
+            self.migrate_appearance_edges()
+        except Exception:
+            logging.error("APPEARANCE edges migration failure")
             
         if not os.path.exists(self.conf_path):
             os.mkdir(self.conf_path)
 
+    def migrate_appearance_edges(self):
+        with self.driver.session(database=DB_NAME) as session:
+            records, _ = self.queries.run(session, 'appearance_migration_done', APPEARANCE_MIGRATION_DONE_QUERY)
+            if records[0]['done']:
+                return
+            start = default_timer()
+            filenames = {file.replace('.json',''): file for file in self._get_files(session)}
+            _, summary = self.queries.run(session, 'appearance_migration', APPEARANCE_MIGRATION_QUERY, filenames=filenames)
+            self.queries.run(session, 'appearance_migration_mark', APPEARANCE_MIGRATION_MARK_QUERY)
+            logging.info(f"Migrated APPEARANCE edges to one edge per file in {default_timer() - start:.2f}s: {summary.counters}")
+
     def get_files(self) -> list[str]:
         with self.driver.session(database=DB_NAME) as session:
-            result = session.run(FILES_QUERY)
-            return next(result)['file']
+            return self._get_files(session)
         
     def _get_files(self,session: Session) -> list[str]:
-        result = session.run(FILES_QUERY)
-        return next(result)['file']
+        records, _ = self.queries.run(session, 'get_files', FILES_QUERY)
+        return records[0]['file']
         
     def get_ners_count(self, json_names: list[str]) -> DataFrame:
-        records = self.driver.execute_query(
+        records = self.queries.execute_query(
+            self.driver,
+            'get_ners_count',
             """MATCH (e: Entity)-[r: USED_IN]->(a:Article)
             WHERE a.filename in $json_names
             RETURN e.entity AS entity, SUM(r.count) AS count, e.type as type""",
@@ -97,84 +336,175 @@ class Neo4jExecutor:
         return DataFrame([record.data() for record in records])
 
 
-    def load_data(self, docs: list[Document], filename: str):
+    def load_data(self, docs: list[Document], filename: str, similarity_config: SimilarityConfig | None = None, load_config: LoadConfig | None = None):
+        load_config = load_config or LoadConfig()
         logging.info("Loading to database new") 
         start = default_timer()
+        job = self.job_store.start(filename, job_fingerprint(docs, similarity_config or SimilarityConfig(), load_config))
 
         with self.driver.session(database=DB_NAME) as session:
-            result = session.run(
-                """CALL {
-                UNWIND $documents AS docs
-                Merge (e:Entity {entity: docs.ent_name, type: docs.ent_type})
-                ON CREATE SET e.index = docs.ent_name + "_" + docs.ent_type
-                Merge (a:Article {url: docs.url, title: docs.title, content: docs.content, lead_content: docs.lead_content, recipe_label: docs.recipe_label, tags: docs.tags, filename: $filename})
-                Merge (e)-[:USED_IN {count: docs.count}]-(a)
-                } IN CONCURRENT TRANSACTIONS
-                """,
-                database_="neo4j",
-                documents=list(chain.from_iterable(doc.neo4j_json_list() for doc in docs)),
-                filename=filename
-            )
-        
-            logging.info(f"Uploading docs, ents nodes and count edges summary: {result.consume().counters}")
+            files = self.get_other_files(session, filename)
+            hashes = self.get_article_hashes(session, filename)
+            changed = self.filter_changed_documents(docs, hashes)
+            if len(changed) == 0 and not job.resumed and self.vector_store.has(filename):
+                logging.info(f"All articles of {filename} are already loaded, skipping")
+                self.job_store.finish(job)
+                return
+            if not job.is_done(STAGE_DOCUMENTS):
+                self.delete_changed_article_edges(session, [doc.url for doc in changed if doc.url in hashes], filename)
+                self.upload_documents(session, changed, filename)
+                job.complete(STAGE_DOCUMENTS)
             logging.info(f"Calculating and uploading similarities between articles")
 
-            result = session.run(
-                SIMILARITY_EDGE_STRING,
-                edges=self._prepare_similarity_links(create_similarity_links(docs))
-            )
-
-            logging.info(f"Uploading document similarity edges summary : {result.consume().counters}")
+            urls = [doc.url for doc in docs]
+            counts = self.vector_store.write(filename, urls, [doc.entities for doc in docs])
+            changed_urls = {doc.url for doc in changed}
+            is_changed = np.array([url in changed_urls for url in urls], dtype=bool)
+            if not job.is_done(STAGE_IN_FILE_SIMILARITY):
+                stage_start = default_timer()
+                links = create_changed_similarity_links(counts, urls, is_changed, similarity_config)
+                logging.info(f"Calculated {len(links)} in-file similarity edges in {default_timer() - stage_start:.2f}s")
+                self.upload_similarity_links(session, links, filename)
+                job.complete(STAGE_IN_FILE_SIMILARITY)
 
-            files = self._get_files(session)
-            files.remove(filename)
+            if load_config.incremental:
+                candidates = self.get_candidate_vectors(session, filename, {ent for doc in changed for ent in doc.entities})
+                files = list(candidates)
             for file in files:
+                if job.is_done(cross_file_stage(file)):
+                    continue
                 logging.info(f"Calculating and uploading similarities for {file}")
-                other_docs = self._get_documents(session,file)
-                links = create_similarity_links_between_files(docs,other_docs)
-                result = session.run(SIMILARITY_EDGE_STRING,edges=self._prepare_similarity_links(links))
-                logging.info(f"Uploading document similarity edges summary for {file} : {result.consume().counters}")
-         
-            result = session.run(
-                CONNECTION_BETWEEN_ENTS_STRING.format(key=filename.replace('.json','')),
-                database_="neo4j",
-                edges=self._get_entity_links(docs) ,
-                filename=filename,
-            )        
-
-            logging.info(f"Uploading entity co-appearance edges summary: {result.consume().counters}")
+                other_urls, other_counts = candidates[file] if load_config.incremental else self.get_document_vectors(session,file)
+                stage_start = default_timer()
+                links = create_changed_similarity_links_between(counts, urls, is_changed, other_counts, other_urls, config=similarity_config)
+                logging.info(f"Calculated {len(links)} similarity edges for {file} in {default_timer() - stage_start:.2f}s")
+                self.upload_similarity_links(session, links, file)
+                job.complete(cross_file_stage(file))
+
+            self.prune_similarity_links(session, filename, similarity_config)
+
+            if not job.is_done(STAGE_APPEARANCE):
+                if len(hashes) > 0:
+                    self.delete_appearance_links(session, filename)
+                self.upload_entity_links(session, entity_cooccurrence(counts, load_config.min_appearance_weight), filename)
+                job.complete(STAGE_APPEARANCE)
+            self.mark_articles_loaded(session, changed, filename)
+            self.job_store.finish(job)
             stop = default_timer()
             logging.info(f"Upload took {stop-start}s")
 
-    def _prepare_similarity_links(self, similarity_links: list[LinkVector]) -> dict[str,str|int]:
-        return [
-                {"url1": sim.url1,
-                "url2": sim.url2,
+    def get_article_hashes(self, session: Session, filename: str) -> dict[str,str]:
+        records, _ = self.queries.run(session, 'get_article_hashes', ARTICLE_HASHES_QUERY, filename=filename)
+        return {record['url']: record['content_hash'] for record in records}
+
+    def filter_changed_documents(self, docs: list[Document], hashes: dict[str,str]) -> list[Document]:
+        changed = [doc for doc in docs if hashes.get(doc.url) != doc.content_hash]
+        logging.info(f"Skipping {len(docs) - len(changed)} articles already loaded with identical content")
+        return changed
+
+    def delete_changed_article_edges(self, session: Session, urls: list[str], filename: str):
+        # Entities and pairs that no longer occur in a changed article would otherwise keep their old edges.
+        if len(urls) == 0:
+            return
+        start = default_timer()
+        _, summary = self.queries.run(session,
+                                      'delete_changed_article_edges',
+                                      DELETE_CHANGED_ARTICLE_EDGES_QUERY.format(rows_per_transaction=self.writer.config.rows_per_transaction),
+                                      filename=filename,
+                                      urls=urls)
+        logging.info(f"Deleted {summary.counters.relationships_deleted} SIMILARITY and USED_IN edges of {len(urls)} changed articles "
+                     f"in {default_timer() - start:.2f}s")
+
+    def delete_appearance_links(self, session: Session, filename: str):
+        _, summary = self.queries.run(session,
+                                      'delete_appearance',
+                                      DELETE_APPEARANCE_QUERY.format(rows_per_transaction=self.writer.config.rows_per_transaction),
+                                      filename=filename)
+        logging.info(f"Deleted {summary.counters.relationships_deleted} APPEARANCE edges of {filename}")
+
+    def mark_articles_loaded(self, session: Session, docs: list[Document], filename: str):
+        self.writer.write(session,
+                          MARK_ARTICLES_LOADED_QUERY,
+                          sorted(({'url': doc.url, 'content_hash': doc.content_hash} for doc in docs), key=lambda row: row['url']),
+                          'mark_articles_loaded',
+                          filename,
+                          filename=filename)
+
+    def get_other_files(self, session: Session, filename: str) -> list[str]:
+        return [file for file in self._get_files(session) if file != filename]
+
+    def upload_documents(self, session: Session, docs: list[Document], filename: str):
+        # Rows are sorted by their node keys so concurrent batches take locks in the same order.
+        articles = {doc.url: doc.neo4j_article() for doc in reversed(docs)}
+        entities = sorted({ent for doc in docs for ent in doc.entities}, key=lambda ent: ent.index)
+        self.writer.write(session, UPLOAD_ARTICLES_QUERY, sorted(articles.values(), key=lambda row: row['url']), 'upload_articles', filename, filename=filename)
+        self.writer.write(session, UPLOAD_ENTITIES_QUERY, [{"name": ent.name, "type": ent.type_} for ent in entities], 'upload_entities', filename)
+        self.writer.write(session,
+                          UPLOAD_USED_IN_QUERY,
+                          sorted(chain.from_iterable(doc.neo4j_used_in() for doc in docs), key=lambda row: (row['entity'], row['url'])),
+                          'upload_used_in',
+                          filename,
+                          filename=filename)
+
+    def upload_similarity_links(self, session: Session, links: list[LinkVector], file: str):
+        self.writer.write(session, SIMILARITY_EDGE_STRING, self._prepare_similarity_links(links), 'upload_similarity_edges', file)
+
+    def prune_similarity_links(self, session: Session, filename: str, similarity_config: SimilarityConfig | None):
+        if similarity_config is None or similarity_config.top_k is None:
+            return
+        start = default_timer()
+        _, summary = self.queries.run(session,
+                                      'prune_similarity_edges',
+                                      PRUNE_SIMILARITY_QUERY.format(rows_per_transaction=self.writer.config.rows_per_transaction),
+                                      filename=filename,
+                                      k=similarity_config.top_k)
+        logging.info(f"Kept top {similarity_config.top_k} SIMILARITY edges around {filename}, removed {summary.counters.relationships_deleted} "
+                     f"in {default_timer() - start:.2f}s")
+
+    def upload_entity_links(self, session: Session, cooccurrence: CooccurrenceBatch, filename: str):
+        self.writer.write(session, CONNECTION_BETWEEN_ENTS_STRING, self._get_entity_links(cooccurrence), 'upload_appearance_edges', filename, filename=filename)
+
+    def _prepare_similarity_links(self, similarity_links: list[LinkVector]) -> list[dict[str,str|float]]:
+        # SIMILARITY is merged undirected, so every pair is sent in one canonical orientation.
+        return sorted((
+                {"url1": min(sim.url1, sim.url2),
+                "url2": max(sim.url1, sim.url2),
                 "cosinus": sim.cosinus,
                 'jaccard': sim.jaccard}
-                for sim in similarity_links]
+                for sim in similarity_links), key=lambda row: (row['url1'], row['url2']))
     
-    def delete_json(self, json_name: str):
-        with self.driver.session() as session:
-            def delete_articles(tx):
-                return tx.run(
-                    "MATCH (a:Article {filename: $filename}) DETACH DELETE a",
-                    filename = json_name
-                )
-            
-            def delete_entities(tx):
-                return tx.run(
-                    "MATCH (e:Entity) WHERE not (e)-[:USED_IN]-() DETACH DELETE e",
-                    filename = json_name
-                )
-            
-            session.execute_write(delete_articles)
-            session.execute_write(delete_entities)
+    def delete_json(self, json_name: str, progress: Callable[[str], None] = logging.info):
+        start = default_timer()
+        rows_per_transaction = self.writer.config.rows_per_transaction
+        with self.driver.session(database=DB_NAME) as session:
+            # Only entities used by the deleted file can become orphans, so only they are checked afterwards.
+            records, _ = self.queries.run(session, 'delete_touched_entities', DELETE_TOUCHED_ENTITIES_QUERY, filename=json_name)
+            entities = records[0]['entities']
+            for name, stage, query in [('delete_appearance', 'APPEARANCE edges', DELETE_APPEARANCE_QUERY),
+                                       ('delete_article_edges', 'SIMILARITY and USED_IN edges', DELETE_ARTICLE_EDGES_QUERY),
+                                       ('delete_articles', 'articles', DELETE_ARTICLES_QUERY)]:
+                stage_start = default_timer()
+                _, summary = self.queries.run(session, name, query.format(rows_per_transaction=rows_per_transaction), filename=json_name)
+                counters = summary.counters
+                progress(f"Deleted {counters.relationships_deleted} relationships and {counters.nodes_deleted} nodes ({stage}) "
+                         f"in {default_timer() - stage_start:.2f}s")
+            stage_start = default_timer()
+            _, summary = self.queries.run(session,
+                                          'delete_orphan_entities',
+                                          DELETE_ORPHAN_ENTITIES_QUERY.format(rows_per_transaction=rows_per_transaction),
+                                          entities=entities)
+            counters = summary.counters
+            progress(f"Deleted {counters.nodes_deleted} of {len(entities)} entities left without articles in {default_timer() - stage_start:.2f}s")
+        self.vector_store.delete(json_name)
+        self.job_store.discard(json_name)
+        progress(f"Removed {json_name} in {default_timer() - start:.2f}s")
             
     def get_linked_ners(self, entity: str, ent_type: str, files: list[str]):
         with self.driver.session() as session:
-            def list_json_files(tx) -> Result:
-                return tx.run(
+            def list_json_files(tx) -> list[Record]:
+                records, _ = self.queries.run(
+                tx,
+                'get_linked_ners',
                 '''MATCH (e:Entity {entity: $entity, type: $ent_type})--(a:Article)
 WHERE (a.filename IN $files) 
 WITH a, e
@@ -186,6 +516,7 @@ RETURN e1, r
                 ent_type=ent_type,
                 files=files
                 )
+                return records
             return_dict: dict[tuple[str,str], int]= dict()
             
             for record in list_json_files(session):
@@ -193,33 +524,9 @@ RETURN e1, r
                 return_dict[key] = return_dict.get(key,0) + record[1]['count']
             return return_dict
         
-    def update_with_communities(self, communities: list[dict[str,str]], key: str,mode: Mode):
-        if mode == Mode.articles:
-            _, summary, _  = self.driver.execute_query(
-                """UNWIND $communities as data
-                MATCH (a: Article)
-                WHERE id(a) = toInteger(data.nodeId)
-                SET a[$key] = data.communityId""",
-                database_="neo4j",
-                communities=communities,
-                key=key
-            )
-            logging.info(f"Updating community nodes in {mode}. Status: {summary.counters}")
-        else:
-            _, summary, _  = self.driver.execute_query(
-                """UNWIND $communities as data
-                MATCH (e: Entity)
-                WHERE id(e) = toInteger(data.nodeId)
-                SET e[$key] = data.communityId""",
-                database_="neo4j",
-                communities=communities,
-                key=key
-            )
-            logging.info(f"Updating community nodes in {mode}. Status: {summary.counters}")
-
     def _get_documents(self, session: Session, filename: str) -> dict[str,dict[Entity,int]]:
         result_dict = defaultdict(dict)
-        result = session.run(GET_DOCUMENT_BY_FILENAME_QUERY, filename=filename)
+        result, _ = self.queries.run(session, 'get_documents', GET_DOCUMENT_BY_FILENAME_QUERY, filename=filename)
 
         for record in result:
             url = record['url']
@@ -228,15 +535,50 @@ RETURN e1, r
 
         return result_dict
 
-    def _get_entity_links(self, docs: list[Document]) -> list[dict[str,str|float]]:
-        summed_counter = sum((doc.return_tuple_connections() for doc in docs),Counter())
-        summed_dict = dict(summed_counter)
+    def get_document_vectors(self, session: Session, filename: str) -> tuple[list[str],csr_matrix]:
+        if not self.vector_store.has(filename):
+            logging.info(f"No local vectors for {filename}, fetching them from database")
+            other_docs = self._get_documents(session, filename)
+            self.vector_store.write(filename, list(other_docs.keys()), list(other_docs.values()))
+        return self.vector_store.read(filename)
+
+    def get_candidate_vectors(self, session: Session, filename: str, entities: set[Entity]) -> dict[str,tuple[list[str],csr_matrix]]:
+        start = default_timer()
+        candidates: dict[str,list[str]] = defaultdict(list)
+        overlap = 0
+        result, _ = self.queries.run(session,
+                                     'candidate_articles',
+                                     CANDIDATE_ARTICLES_QUERY,
+                                     filename=filename,
+                                     entities=[{"name": ent.name, "type": ent.type_} for ent in sorted(entities, key=lambda ent: ent.index)])
+        for record in result:
+            candidates[record['filename']].append(record['url'])
+            overlap += record['overlap']
+        vectors = {file: self._get_candidate_vectors_of_file(session, file, urls) for file, urls in candidates.items()}
+        logging.info(f"Found {sum(len(urls) for urls in candidates.values())} candidate articles in {len(candidates)} files "
+                     f"sharing {overlap} entity occurrences with {filename} in {default_timer() - start:.2f}s")
+        return vectors
+
+    def _get_candidate_vectors_of_file(self, session: Session, filename: str, urls: list[str]) -> tuple[list[str],csr_matrix]:
+        if self.vector_store.has(filename):
+            stored_urls, matrix = self.vector_store.read(filename)
+            rows = {url: idx for idx, url in enumerate(stored_urls)}
+            positions = [rows[url] for url in urls if url in rows]
+            return [stored_urls[idx] for idx in positions], matrix[positions]
+        result_dict = defaultdict(dict)
+        records, _ = self.queries.run(session, 'get_documents_by_urls', GET_DOCUMENT_BY_URLS_QUERY, filename=filename, urls=urls)
+        for record in records:
+            result_dict[record['url']][Entity(name=record['entity'],type_=record['type'])] = record['count']
+        return list(result_dict.keys()), self.vector_store.encode(list(result_dict.values()))
 
+    def _get_entity_links(self, cooccurrence: CooccurrenceBatch) -> list[dict[str,str|float]]:
+        # APPEARANCE edges point from the lower to the higher entity index, so queries can match them directed.
+        entities = list(self.vector_store.vocabulary)
         edges = []
-        for rec, count in summed_dict.items():
-            tup1, tup2 = rec
-            edges.append({'name1': tup1.name, 'type1': tup1.type_, 'name2': tup2.name, 'type2': tup2.type_, 'count': count})
-        return edges
+        for row, col, weight in zip(cooccurrence.rows.tolist(), cooccurrence.cols.tolist(), cooccurrence.weights.tolist()):
+            ent1, ent2 = sorted((entities[row], entities[col]), key=lambda ent: ent.index)
+            edges.append({'name1': ent1.name, 'type1': ent1.type_, 'name2': ent2.name, 'type2': ent2.type_, 'count': weight})
+        return sorted(edges, key=lambda edge: (edge['name1'], edge['type1'], edge['name2'], edge['type2']))
     
     def check_ent_types_integrity(self, matches: Matches, documents: list[Document]) -> set[str]:
         all_ent_types = set(chain.from_iterable([ent.type_ for ent in document.entities] for document in documents))
@@ -0,0 +1,85 @@
+from dataclasses_custom import Entity, Blacklist, EntTypeDictionary
+from pathlib import Path
+from hashlib import sha256
+from time import time
+import sqlite3
+import logging
+import json
+import os
+
+CREATE_TABLE = '''
+CREATE TABLE IF NOT EXISTS ner_cache (
+    key TEXT PRIMARY KEY,
+    entities TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+)'''
+
+CREATE_ACCESS_INDEX = 'CREATE INDEX IF NOT EXISTS ner_cache_last_access ON ner_cache (last_access)'
+
+class NerCache:
+
+    path: Path
+    max_bytes: int
+    hits: int
+    misses: int
+
+    def __init__(self, path: Path, max_bytes: int = 512 * 1024 ** 2):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        if not os.path.exists(self.path.parent):
+            os.mkdir(self.path.parent)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute(CREATE_TABLE)
+        self.connection.execute(CREATE_ACCESS_INDEX)
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(texts: tuple[str,...], model: str, dictionary: EntTypeDictionary, blacklist: Blacklist) -> str:
+        payload = json.dumps([texts, model, sorted(dictionary.items()), sorted(blacklist.ent_types), sorted(blacklist.ent_names)],
+                             ensure_ascii=False)
+        return sha256(payload.encode('utf-8')).hexdigest()
+
+    def reset_counters(self):
+        self.hits, self.misses = 0, 0
+
+    def get_many(self, keys: list[str]) -> dict[str,dict[Entity,int]]:
+        found = dict()
+        unique_keys = list(set(keys))
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            rows = self.connection.execute(
+                f'SELECT key, entities FROM ner_cache WHERE key IN ({",".join("?" * len(chunk))})', chunk
+            ).fetchall()
+            for key, entities in rows:
+                found[key] = {Entity(name=name, type_=type_): count for name, type_, count in json.loads(entities)}
+        self.connection.executemany('UPDATE ner_cache SET last_access = ? WHERE key = ?', [(time(), key) for key in found])
+        self.connection.commit()
+        self.hits += sum(key in found for key in keys)
+        self.misses += sum(key not in found for key in keys)
+        return found
+
+    def put_many(self, entries: dict[str,dict[Entity,int]]):
+        now = time()
+        rows = []
+        for key, entities in entries.items():
+            serialized = json.dumps([[ent.name, ent.type_, count] for ent, count in entities.items()], ensure_ascii=False)
+            rows.append((key, serialized, len(serialized), now))
+        self.connection.executemany('INSERT OR REPLACE INTO ner_cache VALUES (?, ?, ?, ?)', rows)
+        self.connection.commit()
+        self._evict()
+
+    def _evict(self):
+        total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM ner_cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted, freed = 0, 0
+        for key, size in self.connection.execute('SELECT key, size FROM ner_cache ORDER BY last_access').fetchall():
+            if total - freed <= self.max_bytes:
+                break
+            self.connection.execute('DELETE FROM ner_cache WHERE key = ?', (key,))
+            evicted += 1
+            freed += size
+        self.connection.commit()
+        logging.info(f"NER cache evicted {evicted} least recently used entries ({freed} bytes)")
@@ -1,28 +1,53 @@
-from streamlit import file_uploader, status, button, selectbox, session_state, rerun, toggle, dataframe
-from parser import json_to_dict, get_ners, json_with_ner_to_dict, toml_to_config
+from streamlit import file_uploader, status, button, selectbox, session_state, rerun, toggle, dataframe, expander, number_input, info
+from parser import iter_json_documents, get_ners_batch, iter_json_with_ner_documents, toml_to_config
+from typing import BinaryIO
 from shared import init
 from loader import Neo4jExecutor
-from tqdm import tqdm
-from collapser import create_similarity_links
+from dataclasses_custom import SimilarityConfig, NerConfig, LoadConfig, WriteConfig
+from pipeline import ChunkedLoadPipeline
+from os import cpu_count
+from ner_cache import NerCache
+from async_loader import AsyncNeo4jExecutor
+from jobs import stream_fingerprint
+import asyncio
 
-def load_data_action(content: str, conf_content: str, filename: str, ner_format: bool):
+def load_data_action(content: BinaryIO, conf_content: str, filename: str, ner_format: bool, similarity_config: SimilarityConfig, ner_config: NerConfig, load_config: LoadConfig, pipelined: bool = False):
     loader: Neo4jExecutor = session_state['loader']
+    cache: NerCache = session_state['ner_cache']
     status_ = status('Loading data, please wait',expanded=True)
     status_.write('Extracting configuration from toml...')
     matches, blacklist, dictionary = toml_to_config(conf_content)
-    status_.write('Extracting information from json...')
-    if ner_format:
-        documents = json_with_ner_to_dict(content, blacklist)
+    cache.reset_counters()
+    if load_config.chunked:
+        status_.write('Loading in chunks...')
+        fingerprint = stream_fingerprint(content, conf_content, ner_format, similarity_config, load_config)
+        documents = iter_json_with_ner_documents(content, blacklist) if ner_format else iter_json_documents(content)
+        pipeline = ChunkedLoadPipeline(loader, session_state['nlp'], dictionary, blacklist, matches,
+                                       load_config, similarity_config, ner_config, cache)
+        non_matching = pipeline.run(documents, filename, fingerprint, status_.write)
+        status_.write(f'NER cache: {cache.hits} hits, {cache.misses} misses')
     else:
-        documents = json_to_dict(content)
-    status_.write('Extracting Named Entities')
-    for doc in tqdm(documents):
-        if len(doc.entities) == 0:
-            doc.entities = get_ners(doc, session_state['nlp'], dictionary,blacklist)
-    non_matching = loader.check_ent_types_integrity(matches,documents)
+        status_.write('Extracting information from json...')
+        if ner_format:
+            documents = list(iter_json_with_ner_documents(content, blacklist))
+        else:
+            documents = list(iter_json_documents(content))
+        status_.write('Extracting Named Entities')
+        missing = [doc for doc in documents if len(doc.entities) == 0]
+        for doc, entities in zip(missing, get_ners_batch(missing, session_state['nlp'], dictionary, blacklist, ner_config, cache)):
+            doc.entities = entities
+        status_.write(f'NER cache: {cache.hits} hits, {cache.misses} misses')
+        non_matching = loader.check_ent_types_integrity(matches,documents)
+        if len(non_matching) == 0:
+            status_.write('Sending to database...')
+            if pipelined and not load_config.incremental:
+                async_loader: AsyncNeo4jExecutor = session_state['async_loader']
+                timings = asyncio.run(async_loader.load_data(documents, filename, similarity_config, load_config))
+                dataframe([{'stage': stage, 'seconds': round(elapsed, 2)} for stage, elapsed in timings.items()])
+            else:
+                loader.load_data(documents, filename, similarity_config, load_config)
     if len(non_matching) == 0:
-        status_.write('Sending to database...')
-        loader.load_data(documents, filename)
+        session_state['cluster_driver'].projections.invalidate(filename)
         status_.write('Saving Configuration')
         loader.save_matches_config(matches,filename.replace('.json','.toml'))
         status_.update(label='Loading complete!', state='complete', expanded=False)
@@ -33,18 +58,79 @@ def load_data_action(content: str, conf_content: str, filename: str, ner_format:
 init()
 loader: Neo4jExecutor = session_state['loader']
 toggle_with_ner = toggle('Format with extracted NERs',value=False)
+with expander('Loading settings'):
+    chunked = toggle('Chunked loading with bounded memory', value=False)
+    load_chunk_size = number_input('Articles per chunk', min_value=1, value=1000, disabled=not chunked)
+    queue_size = number_input('Chunks buffered between stages', min_value=1, value=2, disabled=not chunked)
+    min_appearance_weight = number_input('Minimal weight of an entity co-appearance edge', min_value=0.0, value=0.0)
+    incremental = toggle('Score only articles of other files sharing an entity (looked up in database)', value=False)
+load_config = LoadConfig(chunked=chunked,
+                         chunk_size=load_chunk_size,
+                         queue_size=queue_size,
+                         min_appearance_weight=min_appearance_weight,
+                         incremental=incremental)
+with expander('Entity extraction settings'):
+    ner_batch_size = number_input('Texts per spaCy batch', min_value=1, value=64)
+    ner_n_process = number_input('spaCy processes (keep 1 when running on GPU)', min_value=1, value=1)
+    ner_cache_mb = number_input('NER cache size limit (MB)', min_value=1, value=512)
+ner_config = NerConfig(batch_size=ner_batch_size, n_process=ner_n_process)
+session_state['ner_cache'].max_bytes = ner_cache_mb * 1024 ** 2
+with expander('Similarity settings'):
+    max_entity_frequency = number_input('Ignore entities present in more articles than this when pairing articles (0 - no limit)', min_value=0, value=0, step=100)
+    approximate = toggle('Approximate similarity (MinHash LSH)', value=False)
+    lsh_bands = number_input('LSH bands', min_value=1, value=32, disabled=not approximate)
+    lsh_rows = number_input('LSH rows per band', min_value=1, value=4, disabled=not approximate)
+    recall_sample_size = number_input('Documents sampled for recall estimate (0 - skip)', min_value=0, value=200, disabled=not approximate)
+    top_k = number_input('Keep only top k neighbours of each article per metric (0 - keep all)', min_value=0, value=0)
+    min_cosinus = number_input('Minimal cosinus similarity of an edge', min_value=0.0, max_value=1.0, value=0.0)
+    min_jaccard = number_input('Minimal modified jaccard similarity of an edge', min_value=0.0, max_value=1.0, value=0.0, format='%.5f')
+    workers = number_input('Similarity worker processes', min_value=1, value=max(1, (cpu_count() or 1) - 1))
+    chunk_size = number_input('Articles per similarity work unit', min_value=1, value=2048)
+similarity_config = SimilarityConfig(max_entity_frequency=max_entity_frequency if max_entity_frequency > 0 else None,
+                                     approximate=approximate,
+                                     lsh_bands=lsh_bands,
+                                     lsh_rows=lsh_rows,
+                                     recall_sample_size=recall_sample_size,
+                                     top_k=top_k if top_k > 0 else None,
+                                     min_cosinus=min_cosinus,
+                                     min_jaccard=min_jaccard,
+                                     workers=workers,
+                                     chunk_size=chunk_size)
+with expander('Database write settings'):
+    write_batch_size = number_input('Rows sent to the database per request', min_value=1, value=20_000, step=1000)
+    rows_per_transaction = number_input('Rows per transaction', min_value=1, value=1000, step=100)
+    write_concurrency = number_input('Concurrent transactions', min_value=1, value=4)
+    write_retries = number_input('Retries of deadlocked batches', min_value=0, value=3)
+    pipelined = toggle('Pipelined upload (score next file while writing the previous one)', value=False, disabled=chunked or incremental)
+    max_in_flight = number_input('Write requests in flight', min_value=1, value=2, disabled=not pipelined)
+loader.writer.config = WriteConfig(batch_size=write_batch_size,
+                                   rows_per_transaction=rows_per_transaction,
+                                   concurrency=write_concurrency,
+                                   max_retries=write_retries,
+                                   max_in_flight=max_in_flight)
+pending_jobs = session_state['job_store'].pending()
+if len(pending_jobs) > 0:
+    info(f'Interrupted loads of {pending_jobs}. Load the same file again to resume from the last completed stage.')
 file = file_uploader(label='Drop here scraped web database', type='json', accept_multiple_files=False)
 conf_file = file_uploader(label='Drop here toml file pointing appropriate entity types', type='toml', accept_multiple_files=False)
 load_button = button('Load')
 delete_choice = selectbox('Remove json file form db', loader.get_files(),index=None)
 delete_button = button('Delete')
 if file is not None and conf_file is not None and load_button:
-    load_data_action(content = file.getvalue().decode('utf-8'),
+    file.seek(0)
+    load_data_action(content = file,
                     conf_content = conf_file.getvalue().decode('utf-8'),
                     filename=file.name,
-                    ner_format=toggle_with_ner)
+                    ner_format=toggle_with_ner,
+                    similarity_config=similarity_config,
+                    ner_config=ner_config,
+                    load_config=load_config,
+                    pipelined=pipelined)
 if delete_choice is not None and delete_button:
-    loader.delete_json(delete_choice)
+    delete_status = status(f'Deleting {delete_choice}, please wait', expanded=True)
+    loader.delete_json(delete_choice, delete_status.write)
+    session_state['cluster_driver'].projections.invalidate(delete_choice)
+    delete_status.update(label='Deleting complete!', state='complete', expanded=False)
     rerun()
   
         
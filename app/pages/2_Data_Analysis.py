@@ -1,10 +1,10 @@
-from streamlit import multiselect, session_state, write, button, plotly_chart, tabs, dataframe, selectbox, metric, columns, error, slider, text
+from streamlit import multiselect, session_state, write, button, plotly_chart, tabs, dataframe, selectbox, metric, columns, error, slider, text, status, expander, number_input, text_input, toggle
 from shared import init
 from loader import Neo4jExecutor
 import plotly.express as px
 from plotly.graph_objects import Pie, Figure, Histogram
 from pandas import Series, DataFrame
-from clustering import GraphClusterer
+from clustering import GraphClusterer, LeidenSummary, ClusteringTask, ClusteringScheduler, parameter_grid
 from community_analyser import Analyzer
 import logging
 from typing import Set
@@ -13,6 +13,8 @@ from dataclasses_custom import Mode, Distance, GraphName
 
 logging.basicConfig(level=logging.INFO)
 
+COLD_RUN_SUFFIX = '_cold'
+
 def enlarge_axes(figure: Figure, range: tuple[float,float] = None, range_y: tuple[float,float] = None) -> Figure:
     xaxis = dict(
         title_font=dict(size=20),     
@@ -130,55 +132,98 @@ def generate_key(selections: str, suffix: str | None = None) -> str:
 
 def collect_mappings(suffix: str, key: str, mode: Mode, distance: Distance | None = None):
     session_state[f'tag_class_mapping_{suffix}'] = analyzer.get_article_tags_class(selections, key, mode)
-    session_state[f'modularities_{suffix}'] = analyzer.calculate_modularity(selections, key, mode, distance)
+    cluster: GraphClusterer = session_state['cluster_driver']
+    graph_name = GraphName.EntitiesWithCoExistance if mode == Mode.entities else GraphName.DocumentWithDistance
+    modularities = cluster.calculate_modularity(selections, graph_name, key, distance)
+    if modularities is None:
+        modularities = analyzer.calculate_modularity(selections, key, mode, distance)
+    session_state[f'modularities_{suffix}'] = modularities
     session_state[f"match_conf_{suffix}"] = analyzer.get_matches_criteria(selections,session_state['conf_path'])
     session_state[f'entity_list_{suffix}'] = analyzer.get_ents_with_key(key,mode)
 
-def cluster_graph(loader: Neo4jExecutor, 
-                  cluster: GraphClusterer, 
-                  suffix: str, 
-                  mode: Mode, 
-                  metric: Distance | None = None):
-    graph_name = GraphName.EntitiesWithCoExistance if 'entit' in suffix else GraphName.DocumentWithDistance
-    logging.info('Generating graph projection')
-    session_state[f'graph_{suffix}'] = cluster.create_graph_projection(selections,graph_name, metric)
-    logging.info('Undergoing Laiden Clasterization')
-    session_state[f'leiden_result_{suffix}'] = cluster.leiden_cluster(session_state[f'graph_{suffix}'])
-    logging.info('Deleting graph projection')
-    cluster.delete_graph_projection(graph_name)
-    logging.info('Updating graph with new communities')
-    loader.update_with_communities(
-        session_state[f'leiden_result_{suffix}'][['nodeId','communityId']].to_dict(orient='records'),
-        session_state[f'key_{suffix}'],
-        mode)
+def clustering_tasks(mode: Mode, incremental: bool, measure_cold_run: bool) -> list[ClusteringTask]:
+    previous = sorted(session_state[f'analyzed_files_{mode.name}'])
+    tasks = []
+    for option in (Distance if mode == Mode.articles else [None]):
+        suffix = mode.name if option is None else mode.name + "_" + option.name
+        key = generate_key(selections, None if option is None else suffix)
+        session_state[f'key_{suffix}'] = key
+        forget_clustering(suffix)
+        if analyzer.is_clustering_needed(key,mode):
+            graph_name = GraphName.EntitiesWithCoExistance if mode == Mode.entities else GraphName.DocumentWithDistance
+            seed_property = None
+            # When files were only added, the stored clustering of the previous selection seeds Leiden.
+            if incremental and len(previous) > 0 and set(previous) < set(selections):
+                previous_key = generate_key(previous, None if option is None else suffix)
+                if not analyzer.is_clustering_needed(previous_key, mode):
+                    seed_property = previous_key
+            tasks.append(ClusteringTask(suffix, graph_name, tuple(selections), key, option, seed_property=seed_property))
+            if seed_property is not None and measure_cold_run:
+                tasks.append(ClusteringTask(suffix + COLD_RUN_SUFFIX, graph_name, tuple(selections), key + COLD_RUN_SUFFIX, option, write=False))
+    return tasks
+
+def run_clusterings(tasks: list[ClusteringTask], max_workers: int, memory_budget: int | None):
+    if len(tasks) == 0:
+        return
+    scheduler = ClusteringScheduler(session_state['cluster_driver'], max_workers, memory_budget)
+    status_ = status(f'Clustering {len(tasks)} graphs, please wait', expanded=True)
+    results: dict[str,LeidenSummary] = dict()
+    for task, summary in scheduler.run(tasks):
+        results[task.suffix] = summary
+        status_.write(f'{task.suffix}: {summary.community_count} communities in {summary.total_millis / 1000: .1f}s')
+        if task.suffix.endswith(COLD_RUN_SUFFIX):
+            continue
+        session_state[f'leiden_summary_{task.suffix}'] = summary
+        if not summary.seeded:
+            session_state[f'cold_millis_per_node_{task.suffix}'] = summary.clustering_millis / max(summary.node_count, 1)
+    # Cold runs are not written, so write time is left out on both sides.
+    for task in tasks:
+        if task.seed_property is None:
+            continue
+        seeded = results[task.suffix]
+        if task.suffix + COLD_RUN_SUFFIX in results:
+            cold_millis, estimated = results[task.suffix + COLD_RUN_SUFFIX].clustering_millis, False
+        elif f'cold_millis_per_node_{task.suffix}' in session_state:
+            cold_millis, estimated = session_state[f'cold_millis_per_node_{task.suffix}'] * seeded.node_count, True
+        else:
+            continue
+        session_state[f'time_saved_{task.suffix}'] = (cold_millis - seeded.clustering_millis, cold_millis, estimated)
+    status_.update(label='Clustering complete!', state='complete', expanded=False)
+
+def show_time_saved(suffix: str):
+    if f'time_saved_{suffix}' not in session_state:
+        return
+    saved, cold_millis, estimated = session_state[f'time_saved_{suffix}']
+    label = 'Time saved by incremental clustering' + (' (against an estimated cold run)' if estimated else ' (against a cold run)')
+    metric(label, f"{saved / 1000: .1f}s", f"{saved * 100 / max(cold_millis, 1): .0f}%")
+
+def community_nodes(suffix: str, mode: Mode) -> DataFrame:
+    if f'leiden_result_{suffix}' not in session_state:
+        key = session_state.get(f'key_{suffix}', '')
+        if key == '':
+            return DataFrame({'communityId': [], 'nodeId': []})
+        session_state[f'leiden_result_{suffix}'] = analyzer.get_community_nodes(key, mode)
+    return session_state[f'leiden_result_{suffix}']
+
+def forget_clustering(suffix: str):
+    for name in (f'leiden_result_{suffix}', f'leiden_summary_{suffix}', f'time_saved_{suffix}'):
+        if name in session_state:
+            del session_state[name]
 
-def collect_data_ents(loader: Neo4jExecutor, cluster: GraphClusterer, analyzer: Analyzer, selections: list[str]):
+def collect_data_ents(analyzer: Analyzer, selections: list[str]):
     mode = Mode.entities
-    key = generate_key(selections)
-    session_state['key_entities'] = key
-    if analyzer.is_clustering_needed(key,mode):
-        cluster_graph(loader,cluster,mode.name, mode)
-    else:
-        session_state['leiden_result_entities'] = analyzer.get_community_nodes(key,mode)
-    collect_mappings(mode.name,key,mode)
+    collect_mappings(mode.name,session_state['key_entities'],mode)
 
-def collect_data_articles(loader: Neo4jExecutor, cluster: GraphClusterer, analyzer: Analyzer, selections: list[str]):
+def collect_data_articles(analyzer: Analyzer, selections: list[str]):
     mode = Mode.articles
     for option in Distance:
         suffix = mode.name + "_" + option.name
-        key = generate_key(selections,suffix)
-        session_state[f'key_{suffix}'] = key
-        if analyzer.is_clustering_needed(key,mode):
-            cluster_graph(loader,cluster,suffix,mode,option)
-        else:
-            session_state[f'leiden_result_{suffix}'] = analyzer.get_community_nodes(key,mode)
-        collect_mappings(suffix,key,mode,option)
+        collect_mappings(suffix,session_state[f'key_{suffix}'],mode,option)
 
 def _clear_cached_data(suffix: str, mode: Mode):
     session_state[f'analyzed_files_{mode.name}'] = set(selections)
     session_state[f'key_{suffix}'] = ''
-    if f'leiden_result_{suffix}' in session_state:
-        del session_state[f'leiden_result_{suffix}']
+    forget_clustering(suffix)
     if f'tag_class_mapping_{suffix}' in session_state:
         del session_state[f'tag_class_mapping_{suffix}']
     if f'modularities_{suffix}' in session_state:
@@ -191,16 +236,47 @@ def clear_cached_data(mode: Mode):
         _clear_cached_data(mode.name + "_" + Distance.cosinus.name, mode)
         _clear_cached_data(mode.name + "_" + Distance.jaccard.name, mode)
     
+def parse_values(values: str, type_: type) -> list:
+    return [type_(value) for value in values.split(',') if value.strip() != '']
+
+def show_parameter_sweep(mode: Mode, suffix: str, distance: Distance | None = None):
+    cluster: GraphClusterer = session_state['cluster_driver']
+    analyzed = sorted(session_state[f'analyzed_files_{mode.name}'])
+    if session_state.get(f'key_{suffix}', '') == '' or len(analyzed) == 0:
+        return
+    graph_name = GraphName.EntitiesWithCoExistance if mode == Mode.entities else GraphName.DocumentWithDistance
+    base_key = generate_key(analyzed, None if mode == Mode.entities else suffix)
+    with expander('Leiden parameter sweep'):
+        gammas = text_input('Gamma values', '0.5, 1.0, 2.0', key=f'sweep_gamma_{suffix}')
+        thetas = text_input('Theta values', '0.01', key=f'sweep_theta_{suffix}')
+        max_levels = text_input('Max levels values', '10', key=f'sweep_levels_{suffix}')
+        seeds = text_input('Random seeds, empty for unseeded runs', '', key=f'sweep_seeds_{suffix}')
+        if button('Run sweep', key=f'sweep_button_{suffix}'):
+            grid = parameter_grid(parse_values(gammas, float), parse_values(thetas, float), parse_values(max_levels, int), parse_values(seeds, int) or [None])
+            if len(grid) == 0:
+                error('Supply at least one gamma, theta and max levels value')
+            else:
+                session_state[f'sweep_{suffix}'] = cluster.sweep(analyzed, graph_name, base_key, grid, distance,
+                                                                 clustering_workers, memory_budget_mib * 2**20 if memory_budget_mib > 0 else None)
+        if f'sweep_{suffix}' in session_state:
+            sweep_result: DataFrame = session_state[f'sweep_{suffix}']
+            dataframe(sweep_result, use_container_width=True)
+            sweep_choice = selectbox('Clustering to analyse', sweep_result['community_property'], index=None, key=f'sweep_choice_{suffix}')
+            if sweep_choice is not None and button('Analyse this clustering', key=f'sweep_adopt_{suffix}'):
+                summary = cluster.adopt(analyzed, graph_name, sweep_choice, distance)
+                session_state[f'key_{suffix}'] = sweep_choice
+                forget_clustering(suffix)
+                session_state[f'leiden_summary_{suffix}'] = summary
+                collect_mappings(suffix, sweep_choice, mode, distance)
+
 def calculate_and_show_chart(mode: Mode, files_changed: bool, select_btn: bool):
     analyzer: Analyzer = session_state['analyzer']
-    cluster: GraphClusterer = session_state['cluster_driver']
-    loader: Neo4jExecutor = session_state['loader']
     if select_btn and files_changed and len(selections) > 0:
         session_state[f'analyzed_files_{mode.name}'] = set(selections)
         if mode == Mode.articles:
-            collect_data_articles(loader,cluster,analyzer,selections)
+            collect_data_articles(analyzer,selections)
         else: 
-            collect_data_ents(loader,cluster,analyzer,selections)
+            collect_data_ents(analyzer,selections)
     elif select_btn and files_changed:
         clear_cached_data(mode)
     if mode == Mode.articles:
@@ -208,8 +284,16 @@ def calculate_and_show_chart(mode: Mode, files_changed: bool, select_btn: bool):
         distance = Distance.jaccard if 'modified' in metric else Distance.cosinus
         suffix = mode.name + "_" + distance.name
     else:
+        distance = None
         suffix = mode.name
-    df = session_state.get(f'leiden_result_{suffix}',DataFrame({'communityId': [], 'nodeId': []}))
+    show_parameter_sweep(mode, suffix, distance)
+    if f'leiden_summary_{suffix}' in session_state:
+        summary: LeidenSummary = session_state[f'leiden_summary_{suffix}']
+        write(f'Leiden found {summary.community_count} communities in {summary.ran_levels} levels, '
+              f'modularity {summary.modularity: .3f}, {summary.total_millis / 1000: .1f}s'
+              + (', seeded with the previous selection' if summary.seeded else ''))
+        show_time_saved(suffix)
+    df = community_nodes(suffix, mode)
     aggregated_df = df.groupby('communityId').aggregate({'nodeId': list}) 
     show_graph_statistics(mode,suffix,aggregated_df.index)
     choice = selectbox(label='Choose community ID', options=aggregated_df.index, key=f'community_selectbox_{suffix}')
@@ -295,7 +379,19 @@ loader: Neo4jExecutor = session_state['loader']
 analyzer: Analyzer = session_state['analyzer']
 selections = multiselect('Ask data from json file',loader.get_files(),[])
 files_changed_articles, files_changed_ents = has_files_changed(set(selections),'articles'), has_files_changed(set(selections),'entities')
+with expander('Clustering settings'):
+    clustering_workers = number_input('Concurrent clustering runs', min_value=1, value=3)
+    memory_budget_mib = number_input('Memory budget of concurrent runs in MiB (0 uses the free GDS heap)', min_value=0, value=0)
+    incremental_clustering = toggle('Seed clustering with the analysed selection when files are added', value=False)
+    measure_cold_run = toggle('Measure the time saved against a cold run', value=False, disabled=not incremental_clustering)
 select_btn = button('Select')
+if select_btn and len(selections) > 0:
+    tasks = []
+    if files_changed_articles:
+        tasks += clustering_tasks(Mode.articles, incremental_clustering, measure_cold_run)
+    if files_changed_ents:
+        tasks += clustering_tasks(Mode.entities, incremental_clustering, measure_cold_run)
+    run_clusterings(tasks, clustering_workers, memory_budget_mib * 2**20 if memory_budget_mib > 0 else None)
 entities, clustering_articles, clustering_ents = tabs(['entities', 'clustering - articles', 'clustering - ents'])
 with entities:
     if select_btn and len(selections) > 0:
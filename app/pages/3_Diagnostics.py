@@ -0,0 +1,32 @@
+from streamlit import session_state, write, dataframe, multiselect, download_button, tabs, json, selectbox, columns
+from shared import init
+from instrumentation import QueryRecorder
+from pandas import DataFrame
+
+def stats_frame(stats: list[dict]) -> DataFrame:
+    df = DataFrame(stats)
+    if df.empty:
+        return df
+    return df[['name', 'calls', 'rows', 'wall_time', 'mean_wall_time', 'max_wall_time', 'available_after', 'consumed_after', 'counters']]
+
+init()
+recorder: QueryRecorder = session_state['query_recorder']
+write('# Query diagnostics')
+last_page, session_totals, plans = tabs(['Last page load', 'Session totals', 'Query plans'])
+with last_page:
+    write('Slowest queries of the page load before opening this page')
+    dataframe(stats_frame(recorder.slowest(recorder.previous)), use_container_width=True)
+with session_totals:
+    dataframe(stats_frame(recorder.slowest(n=len(recorder.totals))), use_container_width=True)
+    json_column, prometheus_column = columns(2)
+    with json_column:
+        download_button('Export JSON', recorder.export_json(), file_name='query_stats.json', mime='application/json')
+    with prometheus_column:
+        download_button('Export Prometheus metrics', recorder.export_prometheus(), file_name='query_stats.prom', mime='text/plain')
+with plans:
+    recorder.profile_names = set(multiselect('Run these queries with PROFILE from now on',
+                                             sorted(set(recorder.totals) | recorder.profile_names),
+                                             default=sorted(recorder.profile_names)))
+    plan_choice = selectbox('Captured plan', sorted(recorder.plans), index=None)
+    if plan_choice is not None:
+        json(recorder.plans[plan_choice])
@@ -1,13 +1,20 @@
 import json
 import logging
-from dataclasses_custom import Document, Blacklist, EntTypeDictionary, Matches, Entity
+from dataclasses_custom import Document, Blacklist, EntTypeDictionary, Matches, Entity, NerConfig
 from spacy.tokens import Span
 from spacy import Language
 from collections import Counter
 import tomllib
+import ijson
+from itertools import chain
+from typing import BinaryIO, Iterator
+from ner_cache import NerCache
 
 logging.basicConfig(level=logging.INFO)
 
+NER_UNUSED_PIPES = ['parser', 'senter']
+NER_LATE_PIPES = ['tagger', 'attribute_ruler']
+
 def toml_to_config(conf_content: str) -> tuple[Matches, Blacklist, EntTypeDictionary]:
     config = tomllib.loads(conf_content)
     blacklist = config['blacklists']
@@ -20,33 +27,41 @@ def toml_to_config(conf_content: str) -> tuple[Matches, Blacklist, EntTypeDictio
     )
         
 def json_to_dict(content: str) -> list[Document]:
-    data = json.loads(content)
-    texts: list[Document] = []
-
     logging.info('Processing texts')
-    for text in data:
-        result_data = text["resultData"]
-
-        url = result_data["url"]
-        recipe_label = result_data["recipeLabel"]
-        for text_data in result_data["results"]:
-            texts.append(Document(
-                url = url,
-                title = text_data["title"],
-                content=text_data["content"],
-                lead_content=text_data['leadContent'],
-                tags=[tag_row['tag'] for tag_row in text_data["tags"]],
-                recipe_label=recipe_label,
-            ))
-    return texts
+    return list(chain.from_iterable(_scraped_item_to_documents(text) for text in json.loads(content)))
 
 def json_with_ner_to_dict(content: str, blacklist: Blacklist) -> list[Document]:
-    data = json.loads(content)
-    texts: list[Document] = []
-    
     logging.info('Processing text with NER')
-    for text in data:
-        texts.append(Document(
+    return [_ner_item_to_document(text, blacklist) for text in json.loads(content)]
+
+def iter_json_documents(stream: BinaryIO) -> Iterator[Document]:
+    logging.info('Streaming texts')
+    for text in ijson.items(stream, 'item', use_float=True):
+        yield from _scraped_item_to_documents(text)
+
+def iter_json_with_ner_documents(stream: BinaryIO, blacklist: Blacklist) -> Iterator[Document]:
+    logging.info('Streaming texts with NER')
+    for text in ijson.items(stream, 'item', use_float=True):
+        yield _ner_item_to_document(text, blacklist)
+
+def _scraped_item_to_documents(text: dict) -> Iterator[Document]:
+    result_data = text["resultData"]
+
+    url = result_data["url"]
+    recipe_label = result_data["recipeLabel"]
+    # Every result of a page is its own article, results after the first get the index as url fragment so their keys stay unique.
+    for index, text_data in enumerate(result_data["results"]):
+        yield Document(
+            url = url if index == 0 else f"{url}#{index}",
+            title = text_data["title"],
+            content=text_data["content"],
+            lead_content=text_data['leadContent'],
+            tags=[tag_row['tag'] for tag_row in text_data["tags"]],
+            recipe_label=recipe_label,
+        )
+
+def _ner_item_to_document(text: dict, blacklist: Blacklist) -> Document:
+    return Document(
         url = text['url'],
         recipe_label = text['objectType'],
         title = text['title'],
@@ -54,9 +69,8 @@ def json_with_ner_to_dict(content: str, blacklist: Blacklist) -> list[Document]:
         content=text['content'],
         lead_content='',
         entities=_extract_ents_from_dict(text['nerObjectCollection']['values'], blacklist)
-        ))
-    return texts
-        
+    )
+
 def _extract_ents_from_dict(ents: list[dict[str,dict[str,int]|str]],
                             blacklist: Blacklist,
                             ) -> dict[tuple[str,str],int]:
@@ -70,11 +84,55 @@ def _extract_ents_from_dict(ents: list[dict[str,dict[str,int]|str]],
         
 def get_ners(doc: Document, nlp: Language, dictionary: EntTypeDictionary, blacklist: Blacklist) -> dict[tuple[str,str],int]:
     logging.info('Extracting entities')
-    lead_content_ents = nlp(doc.lead_content).ents if doc.lead_content != '' else []
-    content_ents = nlp(doc.content).ents
+    return get_ners_batch([doc], nlp, dictionary, blacklist)[0]
+
+def _unused_pipes(nlp: Language) -> list[str]:
+    # Tagger and attribute ruler only matter for lemmas when they run before the lemmatizer.
+    pipe_names = nlp.pipe_names
+    lemmatizer_position = pipe_names.index('lemmatizer') if 'lemmatizer' in pipe_names else -1
+    return [pipe for position, pipe in enumerate(pipe_names)
+            if pipe in NER_UNUSED_PIPES or (pipe in NER_LATE_PIPES and position > lemmatizer_position)]
+
+def get_ners_batch(docs: list[Document],
+                   nlp: Language,
+                   dictionary: EntTypeDictionary,
+                   blacklist: Blacklist,
+                   config: NerConfig | None = None,
+                   cache: NerCache | None = None) -> list[dict[Entity,int]]:
+    config = config or NerConfig()
+    if cache is None:
+        return _run_ner(docs, nlp, dictionary, blacklist, config)
+
+    model = f"{nlp.meta.get('lang')}_{nlp.meta.get('name')}-{nlp.meta.get('version')}"
+    keys = [NerCache.make_key((doc.lead_content, doc.content), model, dictionary, blacklist) for doc in docs]
+    cached = cache.get_many(keys)
+    missing = [idx for idx, key in enumerate(keys) if key not in cached]
+    extracted = _run_ner([docs[idx] for idx in missing], nlp, dictionary, blacklist, config)
+    cache.put_many({keys[idx]: entities for idx, entities in zip(missing, extracted)})
+    cached.update({keys[idx]: entities for idx, entities in zip(missing, extracted)})
+    logging.info(f'NER cache hits: {len(docs) - len(missing)}, misses: {len(missing)}')
+    return [dict(cached[key]) for key in keys]
+
+def _run_ner(docs: list[Document],
+             nlp: Language,
+             dictionary: EntTypeDictionary,
+             blacklist: Blacklist,
+             config: NerConfig) -> list[dict[Entity,int]]:
+    if len(docs) == 0:
+        return []
+    logging.info(f'Extracting entities from {len(docs)} documents')
+
+    def texts():
+        for idx, doc in enumerate(docs):
+            if doc.lead_content != '':
+                yield doc.lead_content, idx
+            yield doc.content, idx
 
-    return dict(Counter(_list_and_filter_entities(lead_content_ents, dictionary,blacklist) +
-                        _list_and_filter_entities(content_ents,dictionary,blacklist)))
+    counters = [Counter() for _ in docs]
+    with nlp.select_pipes(disable=_unused_pipes(nlp)):
+        for spacy_doc, idx in nlp.pipe(texts(), as_tuples=True, batch_size=config.batch_size, n_process=config.n_process):
+            counters[idx].update(_list_and_filter_entities(spacy_doc.ents, dictionary, blacklist))
+    return [dict(counter) for counter in counters]
 
 def _list_and_filter_entities(ents: list[Span], dictionary: EntTypeDictionary, blacklist: Blacklist) -> list[tuple[str,str]]:
     out: list[tuple[str,str]] = []
@@ -0,0 +1,183 @@
+from dataclasses_custom import Document, Matches, Blacklist, EntTypeDictionary, NerConfig, SimilarityConfig, LoadConfig
+from loader import Neo4jExecutor, DB_NAME
+from jobs import chunk_stage, STAGE_APPEARANCE
+from parser import get_ners_batch
+from ner_cache import NerCache
+from collapser import create_changed_similarity_links, create_changed_similarity_links_between, with_columns, entity_cooccurrence
+from scipy.sparse import csr_matrix, vstack
+from threading import Thread, Event
+from queue import Queue, Empty, Full
+from typing import Iterator, Callable
+from timeit import default_timer
+from spacy import Language
+import numpy as np
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+_DONE = object()
+
+class _Failure:
+    def __init__(self, error: Exception):
+        self.error = error
+
+class ChunkedLoadPipeline:
+
+    loader: Neo4jExecutor
+    load_config: LoadConfig
+    similarity_config: SimilarityConfig
+
+    def __init__(self,
+                 loader: Neo4jExecutor,
+                 nlp: Language,
+                 dictionary: EntTypeDictionary,
+                 blacklist: Blacklist,
+                 matches: Matches,
+                 load_config: LoadConfig,
+                 similarity_config: SimilarityConfig,
+                 ner_config: NerConfig,
+                 ner_cache: NerCache | None = None):
+        self.loader = loader
+        self.nlp = nlp
+        self.dictionary = dictionary
+        self.blacklist = blacklist
+        self.matches = matches
+        self.load_config = load_config
+        self.similarity_config = similarity_config
+        self.ner_config = ner_config
+        self.ner_cache = ner_cache
+        self.cancelled = Event()
+
+    def _put(self, queue: Queue, item) -> bool:
+        while not self.cancelled.is_set():
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _get(self, queue: Queue):
+        while not self.cancelled.is_set():
+            try:
+                return queue.get(timeout=0.5)
+            except Empty:
+                continue
+        return _DONE
+
+    def _chunk_documents(self, documents: Iterator[Document], out: Queue):
+        try:
+            chunk = []
+            for doc in documents:
+                chunk.append(doc)
+                if len(chunk) == self.load_config.chunk_size:
+                    if not self._put(out, chunk):
+                        return
+                    chunk = []
+            if len(chunk) > 0 and not self._put(out, chunk):
+                return
+        except Exception as e:
+            self._put(out, _Failure(e))
+            return
+        self._put(out, _DONE)
+
+    def _extract_entities(self, source: Queue, out: Queue):
+        while True:
+            chunk = self._get(source)
+            if chunk is _DONE or isinstance(chunk, _Failure):
+                self._put(out, chunk)
+                return
+            try:
+                missing = [doc for doc in chunk if len(doc.entities) == 0]
+                for doc, entities in zip(missing, get_ners_batch(missing, self.nlp, self.dictionary, self.blacklist, self.ner_config, self.ner_cache)):
+                    doc.entities = entities
+            except Exception as e:
+                self._put(out, _Failure(e))
+                return
+            if not self._put(out, chunk):
+                return
+
+    def run(self, documents: Iterator[Document], filename: str, fingerprint: str, progress: Callable[[str], None] = logging.info) -> set[str]:
+        parsed, extracted = Queue(maxsize=self.load_config.queue_size), Queue(maxsize=self.load_config.queue_size)
+        threads = [Thread(target=self._chunk_documents, args=(documents, parsed), daemon=True),
+                   Thread(target=self._extract_entities, args=(parsed, extracted), daemon=True)]
+        for thread in threads:
+            thread.start()
+        try:
+            return self._upload_chunks(extracted, filename, fingerprint, progress)
+        finally:
+            self.cancelled.set()
+            for thread in threads:
+                thread.join()
+
+    def _upload_chunks(self, source: Queue, filename: str, fingerprint: str, progress: Callable[[str], None]) -> set[str]:
+        store = self.loader.vector_store
+        start = default_timer()
+        # Only urls and entity count vectors of already uploaded chunks are kept.
+        previous_urls: list[str] = []
+        previous_counts: csr_matrix | None = None
+        previous_changed = np.zeros(0, dtype=bool)
+        changed: list[Document] = []
+        job = self.loader.job_store.start(filename, fingerprint)
+
+        with self.loader.driver.session(database=DB_NAME) as session:
+            files = self.loader.get_other_files(session, filename)
+            hashes = self.loader.get_article_hashes(session, filename)
+            other_vectors = {} if self.load_config.incremental else {file: self.loader.get_document_vectors(session, file) for file in files}
+            n_chunk = 0
+            while (chunk := source.get()) is not _DONE:
+                if isinstance(chunk, _Failure):
+                    raise chunk.error
+                n_chunk += 1
+                non_matching = self.loader.check_ent_types_integrity(self.matches, chunk)
+                if len(non_matching) > 0:
+                    if n_chunk > 1:
+                        logging.info(f"Removing partially loaded {filename}")
+                        self.loader.delete_json(filename)
+                    else:
+                        self.loader.job_store.discard(filename)
+                    return non_matching
+
+                chunk_start = default_timer()
+                changed_chunk = self.loader.filter_changed_documents(chunk, hashes)
+                changed.extend(changed_chunk)
+                urls = [doc.url for doc in chunk]
+                changed_urls = {doc.url for doc in changed_chunk}
+                is_changed = np.array([url in changed_urls for url in urls], dtype=bool)
+                counts = store.encode([doc.entities for doc in chunk])
+                # Chunks uploaded before an interruption only rebuild the vectors later chunks are scored against.
+                if not job.is_done(chunk_stage(n_chunk)):
+                    self.loader.delete_changed_article_edges(session, [doc.url for doc in changed_chunk if doc.url in hashes], filename)
+                    self.loader.upload_documents(session, changed_chunk, filename)
+                    links = create_changed_similarity_links(counts, urls, is_changed, self.similarity_config)
+                    if previous_counts is not None:
+                        links += create_changed_similarity_links_between(counts, urls, is_changed, previous_counts, previous_urls, previous_changed, self.similarity_config)
+                    self.loader.upload_similarity_links(session, links, filename)
+                    if self.load_config.incremental:
+                        other_vectors = self.loader.get_candidate_vectors(session, filename, {ent for doc in changed_chunk for ent in doc.entities})
+                    for file, (other_urls, other_counts) in other_vectors.items():
+                        self.loader.upload_similarity_links(
+                            session,
+                            create_changed_similarity_links_between(counts, urls, is_changed, other_counts, other_urls, config=self.similarity_config),
+                            file)
+                    job.complete(chunk_stage(n_chunk))
+
+                n_columns = len(store.vocabulary)
+                previous_counts = with_columns(counts, n_columns) if previous_counts is None else \
+                    vstack([with_columns(previous_counts, n_columns), with_columns(counts, n_columns)], format='csr')
+                previous_urls.extend(urls)
+                previous_changed = np.concatenate([previous_changed, is_changed])
+                progress(f"Loaded chunk {n_chunk} ({len(previous_urls)} articles so far) in {default_timer() - chunk_start:.2f}s")
+
+            if previous_counts is not None:
+                self.loader.prune_similarity_links(session, filename, self.similarity_config)
+                store.save(filename, previous_urls, previous_counts)
+                if not job.is_done(STAGE_APPEARANCE):
+                    if len(hashes) > 0:
+                        self.loader.delete_appearance_links(session, filename)
+                    self.loader.upload_entity_links(session, entity_cooccurrence(previous_counts, self.load_config.min_appearance_weight), filename)
+                    job.complete(STAGE_APPEARANCE)
+                self.loader.mark_articles_loaded(session, changed, filename)
+            self.loader.job_store.finish(job)
+        logging.info(f"Chunked upload of {len(previous_urls)} articles took {default_timer() - start}s")
+        return set()
@@ -1,30 +1,56 @@
-from streamlit import session_state, set_page_config
+from streamlit import session_state, set_page_config, cache_resource
 from loader import Neo4jExecutor
+from async_loader import AsyncNeo4jExecutor
 from spacy import load
-from clustering import GraphClusterer
+from clustering import GraphClusterer, ProjectionRegistry
 from os import getenv
 from neo4j import GraphDatabase
 from graphdatascience import GraphDataScience
 from community_analyser import Analyzer
+from vector_store import DocumentVectorStore
+from ner_cache import NerCache
+from jobs import LoadJobStore
+from instrumentation import QueryRecorder
 import logging
 from pathlib import Path
 
 logging.basicConfig(level=logging.INFO)
 
+# Entity ids of the stored vectors come from one vocabulary, so every session of the process has to share the store.
+@cache_resource
+def _vector_store() -> DocumentVectorStore:
+    return DocumentVectorStore(Path(__file__).absolute().parent / 'vectors')
+
+# Projections of all sessions live in the same GDS catalog, so owners, last use and pins are tracked for the whole process.
+@cache_resource
+def _projection_registry() -> ProjectionRegistry:
+    return ProjectionRegistry()
+
 def init():
     set_page_config(layout="wide")
     if 'conf_path' not in session_state:
         session_state['conf_path'] = Path(__file__).absolute().parent / 'configurations'
+    if 'vector_store' not in session_state:
+        session_state['vector_store'] = _vector_store()
+    if 'ner_cache' not in session_state:
+        session_state['ner_cache'] = NerCache(Path(__file__).absolute().parent / 'cache' / 'ner_cache.sqlite')
+    if 'job_store' not in session_state:
+        session_state['job_store'] = LoadJobStore(Path(__file__).absolute().parent / 'jobs')
+    if 'query_recorder' not in session_state:
+        session_state['query_recorder'] = QueryRecorder()
+    session_state['query_recorder'].start_page_load()
     if 'db_driver' not in session_state:
         session_state['db_driver'] = GraphDatabase.driver(getenv('DATABASE_URL'),auth=(getenv('DATABASE_USR'),getenv('DATABASE_PASSWORD'))) 
     if 'gds_driver' not in session_state:
         session_state['gds_driver'] =  GraphDataScience(getenv('DATABASE_URL'),auth=(getenv('DATABASE_USR'),getenv('DATABASE_PASSWORD')))
     if 'loader' not in session_state:
-        session_state['loader'] = Neo4jExecutor(session_state['db_driver'], session_state['conf_path'])
+        session_state['loader'] = Neo4jExecutor(session_state['db_driver'], session_state['conf_path'], session_state['vector_store'], session_state['job_store'], session_state['query_recorder'])
+    if 'async_loader' not in session_state:
+        session_state['async_loader'] = AsyncNeo4jExecutor(session_state['loader'], getenv('DATABASE_URL'), (getenv('DATABASE_USR'),getenv('DATABASE_PASSWORD')))
     if 'cluster_driver' not in session_state:
-        session_state['cluster_driver'] = GraphClusterer(session_state['gds_driver'])
+        session_state['cluster_driver'] = GraphClusterer(session_state['gds_driver'], _projection_registry())
     if 'analyzer' not in session_state:
-        session_state['analyzer'] = Analyzer(session_state['db_driver'], session_state['gds_driver'])
+        session_state['analyzer'] = Analyzer(session_state['db_driver'], session_state['gds_driver'], session_state['query_recorder'])
     if 'analyzed_files_articles' not in session_state:
         session_state['analyzed_files_articles'] = set()
     if 'analyzed_files_entities' not in session_state:
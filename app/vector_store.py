@@ -0,0 +1,114 @@
+from dataclasses_custom import Entity
+from collapser import build_count_matrix
+from scipy.sparse import csr_matrix
+from pathlib import Path
+from threading import RLock
+from contextlib import contextmanager
+import numpy as np
+import logging
+import shutil
+import json
+import fcntl
+import os
+
+VOCABULARY_FILE = 'vocabulary.json'
+URLS_FILE = 'urls.json'
+LOCK_FILE = 'vocabulary.lock'
+
+class DocumentVectorStore:
+
+    root: Path
+    vocabulary: dict[Entity,int]
+
+    def __init__(self, root: Path):
+        self.root = root
+        if not os.path.exists(self.root):
+            os.mkdir(self.root)
+        self._lock = RLock()
+        self._vocabulary_version = None
+        self.vocabulary = dict()
+        self._refresh_vocabulary()
+
+    @contextmanager
+    def _locked(self):
+        # Sessions share one store per process, other processes (the bulk import cli) are excluded by a file lock.
+        with self._lock, open(self.root / LOCK_FILE, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _refresh_vocabulary(self):
+        # The vocabulary only grows, so a newer file on disk extends the one in memory without moving any id.
+        path = self.root / VOCABULARY_FILE
+        if not path.exists():
+            return
+        stat = path.stat()
+        if (stat.st_mtime_ns, stat.st_size) == self._vocabulary_version:
+            return
+        with open(path, 'r', encoding='utf-8') as file:
+            self.vocabulary = {Entity(name=name, type_=type_): idx for idx, (name, type_) in enumerate(json.load(file))}
+        self._vocabulary_version = (stat.st_mtime_ns, stat.st_size)
+
+    def _write_vocabulary(self, vocabulary: dict[Entity,int]):
+        path = self.root / VOCABULARY_FILE
+        with open(path.with_suffix('.tmp'), 'w', encoding='utf-8') as file:
+            json.dump([[ent.name, ent.type_] for ent in vocabulary], file, ensure_ascii=False)
+        os.replace(path.with_suffix('.tmp'), path)
+        stat = path.stat()
+        self._vocabulary_version = (stat.st_mtime_ns, stat.st_size)
+
+    def _file_path(self, filename: str) -> Path:
+        return self.root / filename.replace('.json','')
+
+    def has(self, filename: str) -> bool:
+        return (self._file_path(filename) / URLS_FILE).exists()
+
+    def encode(self, entity_maps: list[dict[Entity,int]]) -> csr_matrix:
+        with self._locked():
+            self._refresh_vocabulary()
+            # A copy is extended, so readers of the old vocabulary never see it change under them.
+            vocabulary = dict(self.vocabulary)
+            for ents in entity_maps:
+                for ent in ents:
+                    vocabulary.setdefault(ent, len(vocabulary))
+            if len(vocabulary) > len(self.vocabulary):
+                self._write_vocabulary(vocabulary)
+                self.vocabulary = vocabulary
+        return build_count_matrix(entity_maps, vocabulary)
+
+    def write(self, filename: str, urls: list[str], entity_maps: list[dict[Entity,int]]) -> csr_matrix:
+        return self.save(filename, urls, self.encode(entity_maps))
+
+    def save(self, filename: str, urls: list[str], matrix: csr_matrix) -> csr_matrix:
+        path = self._file_path(filename)
+        if path.exists():
+            shutil.rmtree(path)
+        os.mkdir(path)
+        np.save(path / 'indptr.npy', matrix.indptr)
+        np.save(path / 'indices.npy', matrix.indices)
+        np.save(path / 'data.npy', matrix.data)
+        # Urls are written last, so a file only counts as stored once all of its arrays are on disk.
+        with open(path / URLS_FILE, 'w', encoding='utf-8') as file:
+            json.dump(urls, file, ensure_ascii=False)
+        logging.info(f"Stored {len(urls)} document vectors of {filename}")
+        return matrix
+
+    def read(self, filename: str) -> tuple[list[str], csr_matrix]:
+        path = self._file_path(filename)
+        with self._locked():
+            self._refresh_vocabulary()
+        with open(path / URLS_FILE, 'r', encoding='utf-8') as file:
+            urls = json.load(file)
+        matrix = csr_matrix((np.load(path / 'data.npy', mmap_mode='r'),
+                             np.load(path / 'indices.npy', mmap_mode='r'),
+                             np.load(path / 'indptr.npy', mmap_mode='r')),
+                            shape=(len(urls), len(self.vocabulary)))
+        return urls, matrix
+
+    def delete(self, filename: str):
+        path = self._file_path(filename)
+        if path.exists():
+            shutil.rmtree(path)
+            logging.info(f"Removed document vectors of {filename}")